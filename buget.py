@@ -0,0 +1,55 @@
+"""
+Extragerea bugetului din cerința utilizatorului, comună pentru script2_consultant_aiV1 și
+script2_consultant_aiV2 (pre-filtrarea după buget, fără AI).
+"""
+import re
+from typing import Optional
+
+# Cursuri aproximative de conversie în EUR pentru monedele recunoscute în cerere
+CURS_EUR = {"eur": 1.0, "euro": 1.0, "€": 1.0, "ron": 0.2, "lei": 0.2, "usd": 0.92, "dolari": 0.92, "$": 0.92}
+MULTIPLICATORI = {"k": 1_000, "mii": 1_000}
+# Suma acceptă separatori de mii (spațiu, NBSP, punct sau virgulă) și zecimale: "10 000", "20.000", "1.500,50", "2,5"
+BUDGET_RE = re.compile(
+    r"(?P<prefix>€|\$)?\s*(?P<suma>\d{1,3}(?:[ .,\u00a0]\d{3})+(?:[.,]\d+)?|\d+(?:[.,]\d+)?)\s*"
+    r"(?P<mult>k|mii)?\s*(?P<moneda>euro|eur|€|ron|lei|usd|dolari|\$)?",
+    re.IGNORECASE,
+)
+# Sub acest prag suma nu poate fi bugetul unei renovări (ex: "50 euro/mp"), deci decizia rămâne la AI
+BUGET_MINIM_EUR = 500
+
+def parse_amount(text: str) -> float:
+    """Transformă '10 000', '20.000', '20,000', '1.500,50' sau '2,5' într-un număr."""
+    text = text.replace(" ", "").replace("\u00a0", "")
+    if "." in text and "," in text:
+        decimal_sep = "." if text.rfind(".") > text.rfind(",") else ","
+        thousands_sep = "," if decimal_sep == "." else "."
+        return float(text.replace(thousands_sep, "").replace(decimal_sep, "."))
+    for sep in ".,":
+        if sep in text:
+            groups = text.split(sep)
+            if all(len(group) == 3 for group in groups[1:]):
+                return float(text.replace(sep, ""))
+            return float(text.replace(sep, "."))
+    return float(text)
+
+def extract_budget_eur(cerinta_user: str) -> Optional[float]:
+    """
+    Extrage bugetul în EUR din cerința utilizatorului. Returnează None când cerința
+    este ambiguă (nicio sumă cu monedă sau mai multe sume diferite) sau când suma este
+    prea mică pentru a fi un buget, caz în care decizia rămâne la AI.
+    """
+    budgets = set()
+    for match in BUDGET_RE.finditer(cerinta_user):
+        currency = (match.group("moneda") or match.group("prefix") or "").lower()
+        if not currency:
+            continue
+        try:
+            amount = parse_amount(match.group("suma"))
+        except ValueError:
+            continue
+        amount *= MULTIPLICATORI.get((match.group("mult") or "").lower(), 1)
+        budgets.add(amount * CURS_EUR[currency])
+    if len(budgets) != 1:
+        return None
+    buget = budgets.pop()
+    return buget if buget >= BUGET_MINIM_EUR else None
@@ -1,20 +1,30 @@
+import asyncio
+import hashlib
+import io
+import itertools
+import math
 import google.generativeai as genai
 import os
+import time
 from PIL import Image
 import json
-from tqdm import tqdm
+from tqdm.asyncio import tqdm
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServiceUnavailable
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_combine, wait_random_exponential
 
 # --- CONFIGURARE ---
 # 1. Obține cheia API de la Google AI Studio: https://aistudio.google.com/app/apikey
 # 2. Setează cheia ca variabilă de mediu numită "GOOGLE_API_KEY"
 #    sau adaug-o direct aici (nerecomandat pentru siguranță):
 #    GOOGLE_API_KEY = "CHEIA_TA_API_AICI"
-try:
-    genai.configure(api_key=os.environ["tudsecret"])
-except KeyError:
-    print("EROARE: Variabila de mediu GOOGLE_API_KEY nu este setată.")
+# GOOGLE_API_KEYS poate conține mai multe chei separate prin virgulă; cererile sunt distribuite între ele.
+api_keys = [k.strip() for k in os.environ.get("GOOGLE_API_KEYS", os.environ.get("tudsecret", "")).split(",") if k.strip()]
+if not api_keys:
+    print("EROARE: Variabila de mediu GOOGLE_API_KEYS (sau tudsecret) nu este setată.")
     print("Te rog configurează cheia API conform instrucțiunilor din cod.")
     exit()
+genai.configure(api_key=api_keys[0])
 
 # --- DEFINIREA FOLDERELOR ---
 INPUT_FOLDER = "Locatii_de_Analizat"
@@ -23,8 +33,163 @@ OUTPUT_FOLDER = "Analiza_JSON"
 # Crearea folderului de output dacă nu există
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+GEMINI_MODEL = 'gemini-2.5-flash'
 
-def analyze_location(location_folder_path):
+# Numărul maxim de cereri Gemini trimise simultan (free tier-ul acceptă ~2-5)
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
+
+
+# --- LIMITARE PROACTIVĂ A RATEI (RPM / TPM) ---
+# Limitatoarele sunt globale, deci toate corutinele din proces împart aceeași cotă.
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+IMAGE_TOKENS = 258  # costul fix al unei imagini (un tile de 768x768)
+
+# Fiecare cheie are propria cotă, deci limitele cresc cu numărul de chei
+rpm_limiter = AsyncLimiter(GEMINI_RPM * len(api_keys), 60)
+tpm_limiter = AsyncLimiter(max(GEMINI_TPM * len(api_keys) // 1000, 1), 60)  # un permis = 1000 de tokeni
+
+
+def estimate_tokens(contents):
+    """Estimare grosieră a tokenilor de intrare: ~4 caractere per token, 258 per imagine."""
+    if isinstance(contents, str):
+        contents = [contents]
+    return sum(len(part) // 4 if isinstance(part, str) else IMAGE_TOKENS for part in contents)
+
+
+async def throttle(contents):
+    """Așteaptă până când cererea încape atât în limita RPM, cât și în cea TPM."""
+    permits = math.ceil(estimate_tokens(contents) / 1000)
+    await tpm_limiter.acquire(min(max(permits, 1), tpm_limiter.max_rate))
+    await rpm_limiter.acquire()
+
+
+# --- REÎNCERCĂRI LA ERORI TEMPORARE (429 / 503 / 504) ---
+def wait_retry_after(retry_state):
+    """Respectă întârzierea cerută de server (RetryInfo), dacă aceasta există."""
+    exc = retry_state.outcome.exception()
+    for detail in getattr(exc, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return 0
+
+
+# --- ROTAȚIA CHEILOR API ---
+# O cheie care a primit 429 este ocolită timp de KEY_COOLDOWN_SECONDS.
+KEY_COOLDOWN_SECONDS = 60
+_key_cycle = itertools.cycle(range(len(api_keys)))
+_key_cooling_until = [0.0] * len(api_keys)
+_current_key = [0]
+
+def next_key_index():
+    """Următoarea cheie din rotație care nu este în pauză (sau cea care iese prima din pauză)."""
+    now = time.monotonic()
+    for _ in range(len(api_keys)):
+        i = next(_key_cycle)
+        if _key_cooling_until[i] <= now:
+            return i
+    return min(range(len(api_keys)), key=_key_cooling_until.__getitem__)
+
+def mark_key_cooling(i):
+    """Pune cheia în pauză după un 429."""
+    _key_cooling_until[i] = time.monotonic() + KEY_COOLDOWN_SECONDS
+
+@retry(
+    retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable, DeadlineExceeded)),
+    wait=wait_combine(wait_retry_after, wait_random_exponential(multiplier=1, max=60)),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def generate_with_retry(contents):
+    """
+    Trimite cererea către Gemini, reîncercând automat când limita de rată este depășită.
+    Fiecare încercare alege o cheie nouă din rotație.
+    """
+    await throttle(contents)
+    i = next_key_index()
+    # SDK-ul are o singură configurare globală: cheia este setată și modelul este creat chiar
+    # înainte de apel, fără niciun await între ele, deci nicio altă corutină nu poate interveni.
+    # Modelul își ia clientul la primul apel și îl păstrează, chiar dacă cheia se schimbă ulterior.
+    if _current_key[0] != i:
+        genai.configure(api_key=api_keys[i])
+        _current_key[0] = i
+    model = genai.GenerativeModel(GEMINI_MODEL)
+    try:
+        return await model.generate_content_async(contents)
+    except ResourceExhausted:
+        mark_key_cooling(i)
+        raise
+
+# --- PREGĂTIREA IMAGINILOR ---
+# Gemini împarte imaginile în tile-uri de 768x768, deci rezoluțiile mai mari doar cresc upload-ul.
+IMAGE_MAX_SIZE = 1024
+IMAGE_JPEG_QUALITY = 85
+IMAGE_CACHE_FOLDER = ".cache_imagini"
+
+
+def load_and_resize(img_path):
+    """
+    Redimensionează imaginea la maxim 1024px pe latura lungă și o recomprimă ca JPEG.
+    Rezultatul este păstrat în IMAGE_CACHE_FOLDER sub hash-ul conținutului original,
+    astfel încât rulările ulterioare să nu mai refacă procesarea.
+    """
+    with open(img_path, 'rb') as f:
+        raw = f.read()
+    cache_path = os.path.join(IMAGE_CACHE_FOLDER, f"{hashlib.sha256(raw).hexdigest()}.jpg")
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return f.read()
+
+    img = Image.open(io.BytesIO(raw))
+    img.thumbnail((IMAGE_MAX_SIZE, IMAGE_MAX_SIZE), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    data = buf.getvalue()
+
+    os.makedirs(IMAGE_CACHE_FOLDER, exist_ok=True)
+    with open(cache_path, 'wb') as f:
+        f.write(data)
+    return data
+
+# --- CACHE PENTRU ANALIZE ---
+# Aceleași imagini + același model + aceeași versiune de prompt => aceeași analiză.
+# Incrementează PROMPT_VERSION ori de câte ori modifici prompt-ul.
+PROMPT_VERSION = "1"
+ANALYSIS_CACHE_FOLDER = ".cache_analize"
+
+
+def analysis_cache_key(img_paths):
+    """Cheia cache-ului: hash-urile imaginilor (în ordine sortată), modelul și versiunea prompt-ului."""
+    image_hashes = []
+    for img_path in img_paths:
+        with open(img_path, 'rb') as f:
+            image_hashes.append(hashlib.sha256(f.read()).hexdigest())
+    h = hashlib.sha256()
+    for image_hash in sorted(image_hashes):
+        h.update(image_hash.encode())
+    h.update(f"{GEMINI_MODEL}:{PROMPT_VERSION}".encode())
+    return h.hexdigest()
+
+
+def read_cached_analysis(cache_key):
+    """Returnează analiza salvată pentru cheia dată sau None dacă nu există."""
+    cache_path = os.path.join(ANALYSIS_CACHE_FOLDER, f"{cache_key}.json")
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_cached_analysis(cache_key, analysis_json):
+    """Salvează analiza pe disc sub cheia dată."""
+    os.makedirs(ANALYSIS_CACHE_FOLDER, exist_ok=True)
+    with open(os.path.join(ANALYSIS_CACHE_FOLDER, f"{cache_key}.json"), 'w', encoding='utf-8') as f:
+        json.dump(analysis_json, f, ensure_ascii=False)
+
+
+
+async def analyze_location(location_folder_path):
     """
     Analizează toate imaginile dintr-un folder și returnează un JSON cu costurile de renovare.
     """
@@ -39,16 +204,26 @@ def analyze_location(location_folder_path):
         print(f"AVERTISMENT: Nu am găsit imagini în folderul {location_name}. Sar peste.")
         return None
 
-    for image_file in image_files:
-        try:
-            img_path = os.path.join(location_folder_path, image_file)
-            img = Image.open(img_path)
-            image_parts.append(img)
-        except Exception as e:
-            print(f" AVERTISMENT: Nu am putut încărca imaginea {image_file}. Eroare: {e}")
+    img_paths = [os.path.join(location_folder_path, image_file) for image_file in image_files]
+    cache_key = await asyncio.to_thread(analysis_cache_key, img_paths)
+    cached_analysis = read_cached_analysis(cache_key)
+    if cached_analysis is not None:
+        print(f" Analiza pentru {location_name} a fost găsită în cache. Nu mai apelez AI-ul.")
+        return cached_analysis
+
+    # Decodarea și redimensionarea rulează în paralel, în thread-uri (PIL eliberează GIL-ul în libjpeg/libpng)
+    loaded = await asyncio.gather(*(asyncio.to_thread(load_and_resize, p) for p in img_paths), return_exceptions=True)
+    for image_file, data in zip(image_files, loaded):
+        if isinstance(data, Exception):
+            print(f" AVERTISMENT: Nu am putut încărca imaginea {image_file}. Eroare: {data}")
+        else:
+            image_parts.append({'mime_type': 'image/jpeg', 'data': data})
+    # Cheia de cache acoperă toate imaginile, deci o analiză pe un set incomplet nu este salvată
+    if len(image_parts) != len(img_paths):
+        print(f" EROARE: Nu toate imaginile pentru {location_name} au putut fi încărcate. Sar peste.")
+        return None
 
-    # Definirea modelului și a prompt-ului
-    model = genai.GenerativeModel('gemini-2.5-flash')
+    # Definirea prompt-ului (modelul este creat la fiecare încercare, vezi generate_with_retry)
     
     prompt_text = """
     Analizează următoarele imagini ale unei proprietăți imobiliare din România. Acționează ca un expert în renovări.
@@ -79,43 +254,59 @@ def analyze_location(location_folder_path):
     try:
         # Generarea răspunsului de la AI
         print(" Se trimit imaginile către AI pentru analiză... (acest pas poate dura)")
-        response = model.generate_content([prompt_text] + image_parts)
+        response = await generate_with_retry([prompt_text] + image_parts)
         
         # Curățarea și parsarea răspunsului JSON
         cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
         analysis_json = json.loads(cleaned_response)
-        
+        write_cached_analysis(cache_key, analysis_json)
+
         return analysis_json
 
     except Exception as e:
         print(f" EROARE la analiza AI pentru {location_name}: {e}")
         return None
 
-# --- EXECUȚIA PRINCIPALĂ ---
-if __name__ == "__main__":
+async def process_location(location_name, semaphore):
+    """
+    Rulează analiza pentru o singură locație și salvează rezultatul pe disc.
+    """
+    location_path = os.path.join(INPUT_FOLDER, location_name)
+
+    # Verificăm dacă analiza există deja pentru a nu re-procesa
+    output_file_path = os.path.join(OUTPUT_FOLDER, f"{location_name}.json")
+    if os.path.exists(output_file_path):
+        print(f"\nAnaliza pentru {location_name} există deja. Sar peste.")
+        return
+
+    # Rulăm analiza (limitat de semafor)
+    async with semaphore:
+        result = await analyze_location(location_path)
+
+    # Salvăm rezultatul
+    if result:
+        with open(output_file_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f" Analiza pentru {location_name} a fost salvată cu succes!")
+
+
+async def main():
     if not os.path.isdir(INPUT_FOLDER):
         print(f"EROARE: Folderul de intrare '{INPUT_FOLDER}' nu există. Te rog creează-l și adaugă foldere cu locații.")
-    else:
-        location_folders = [d for d in os.listdir(INPUT_FOLDER) if os.path.isdir(os.path.join(INPUT_FOLDER, d))]
-        
-        print(f"Am găsit {len(location_folders)} locații de analizat.")
-        
-        for location_name in tqdm(location_folders, desc="Progres total analiză"):
-            location_path = os.path.join(INPUT_FOLDER, location_name)
-            
-            # Verificăm dacă analiza există deja pentru a nu re-procesa
-            output_file_path = os.path.join(OUTPUT_FOLDER, f"{location_name}.json")
-            if os.path.exists(output_file_path):
-                print(f"\nAnaliza pentru {location_name} există deja. Sar peste.")
-                continue
-
-            # Rulăm analiza
-            result = analyze_location(location_path)
-            
-            # Salvăm rezultatul
-            if result:
-                with open(output_file_path, 'w', encoding='utf-8') as f:
-                    json.dump(result, f, indent=2, ensure_ascii=False)
-                print(f" Analiza pentru {location_name} a fost salvată cu succes!")
-
-        print("\nAnaliză finalizată pentru toate locațiile!")
\ No newline at end of file
+        return
+
+    location_folders = [d for d in os.listdir(INPUT_FOLDER) if os.path.isdir(os.path.join(INPUT_FOLDER, d))]
+
+    print(f"Am găsit {len(location_folders)} locații de analizat.")
+
+    # Toate locațiile pornesc simultan; semaforul limitează cererile active către Gemini
+    semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    tasks = [asyncio.create_task(process_location(name, semaphore)) for name in location_folders]
+    for task in tqdm.as_completed(tasks, desc="Progres total analiză"):
+        await task
+
+    print("\nAnaliză finalizată pentru toate locațiile!")
+
+# --- EXECUȚIA PRINCIPALĂ ---
+if __name__ == "__main__":
+    asyncio.run(main())
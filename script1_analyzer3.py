@@ -1,8 +1,22 @@
-import google.generativeai as genai
+import argparse
+import asyncio
+import hashlib
+import io
+import itertools
+import math
 import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from PIL import Image
 import json
-from tqdm import tqdm
+from tqdm.asyncio import tqdm
+from google import genai
+from google.genai import errors, types
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_combine, wait_random_exponential
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
@@ -18,41 +32,36 @@ if not url or not key:
 supabase: Client = create_client(url, key)
 print("🔗 Conectat la Supabase cu succes!")
 
-# Configurare Google AI
-try:
-    genai.configure(api_key=os.environ["tudsecret"])
-except KeyError:
-    print("❌ EROARE: Variabila de mediu 'tudsecret' pentru cheia Google API nu este setată.")
+# Configurare Google AI (SDK-ul nou, necesar pentru Batch API)
+# GOOGLE_API_KEYS poate conține mai multe chei separate prin virgulă; cererile interactive
+# sunt distribuite între ele, iar job-urile batch folosesc mereu prima cheie.
+api_keys = [k.strip() for k in os.environ.get("GOOGLE_API_KEYS", os.environ.get("tudsecret", "")).split(",") if k.strip()]
+if not api_keys:
+    print("❌ EROARE: Setează 'GOOGLE_API_KEYS' sau 'tudsecret' cu cheia (cheile) Google API.")
     exit()
+clients = [genai.Client(api_key=k) for k in api_keys]
+# Fișierele încărcate prin Files API aparțin proiectului cheii, deci sunt indexate per cheie
+client_ids = [hashlib.sha256(k.encode()).hexdigest()[:12] for k in api_keys]
+client = clients[0]
 
 # --- 2. DEFINIREA FUNCȚIILOR ---
 INPUT_FOLDER = "Locatii_de_Analizat"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+GEMINI_MODEL = 'gemini-2.5-pro'
 
-def analyze_location(location_folder_path):
-    """
-    Analizează toate imaginile dintr-un folder și returnează un JSON cu costurile de renovare.
-    """
-    image_parts = []
-    folder_name = os.path.basename(location_folder_path)
-    
-    print(f"\n🔍 Procesare imagini pentru: {folder_name}")
-    image_files = [f for f in os.listdir(location_folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))]
-    
-    if not image_files:
-        print(f"⚠️ AVERTISMENT: Nu am găsit imagini în folderul {folder_name}. Sar peste analiza AI.")
-        return None
+# Numărul maxim de cereri Gemini trimise simultan (free tier-ul acceptă ~2-5)
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
 
-    for image_file in image_files:
-        try:
-            img_path = os.path.join(location_folder_path, image_file)
-            img = Image.open(img_path)
-            image_parts.append(img)
-        except Exception as e:
-            print(f" AVERTISMENT: Nu am putut încărca imaginea {image_file}. Eroare: {e}")
+# Rândurile noi sunt inserate în Supabase în loturi de această mărime
+INSERT_BATCH_SIZE = 50
+
+# Intervalul de verificare a job-ului batch (crește exponențial până la maxim)
+BATCH_POLL_INITIAL_SECONDS = 10
+BATCH_POLL_MAX_SECONDS = 300
+BATCH_UPLOAD_MIN_REMAINING = timedelta(hours=24)
+BATCH_FINAL_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
 
-    model = genai.GenerativeModel('gemini-2.5-pro')
-    
-    prompt_text = """
+PROMPT_TEXT = """
     Analizează următoarele imagini ale unei proprietăți imobiliare din România. Acționează ca un expert în renovări.
     Obiectivul tău este să identifici TOATE elementele care necesită renovare, reparație sau înlocuire pentru a aduce proprietatea la un standard modern, potrivit pentru închiriere.
     Returnează răspunsul STRICT în format JSON, fără niciun alt text înainte sau după. Structura JSON trebuie să fie următoarea:
@@ -69,73 +78,511 @@ def analyze_location(location_folder_path):
       "rezumat_analiza": "<string>"
     }
     """
-    
+
+# --- LIMITARE PROACTIVĂ A RATEI (RPM / TPM) ---
+# Limitatoarele sunt globale, deci toate corutinele din proces împart aceeași cotă.
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "5"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+IMAGE_TOKENS = 258  # costul fix al unei imagini (un tile de 768x768)
+
+# Limitele sunt per cheie, deci cota totală crește cu numărul de chei disponibile
+rpm_limiter = AsyncLimiter(GEMINI_RPM * len(clients), 60)
+tpm_limiter = AsyncLimiter(max(GEMINI_TPM * len(clients) // 1000, 1), 60)  # un permis = 1000 de tokeni
+
+def estimate_tokens(contents):
+    """Estimare grosieră a tokenilor de intrare: ~4 caractere per token, 258 per imagine."""
+    if isinstance(contents, str):
+        contents = [contents]
+    return sum(len(part) // 4 if isinstance(part, str) else IMAGE_TOKENS for part in contents)
+
+async def throttle(contents):
+    """Așteaptă până când cererea încape atât în limita RPM, cât și în cea TPM."""
+    permits = math.ceil(estimate_tokens(contents) / 1000)
+    await tpm_limiter.acquire(min(max(permits, 1), tpm_limiter.max_rate))
+    await rpm_limiter.acquire()
+
+# --- REÎNCERCĂRI LA ERORI TEMPORARE (429 / 503 / 504) ---
+RETRYABLE_STATUS_CODES = {429, 503, 504}
+
+def is_retryable(exc: BaseException) -> bool:
+    """Doar limitarea de rată și indisponibilitatea temporară merită reîncercate."""
+    return isinstance(exc, errors.APIError) and exc.code in RETRYABLE_STATUS_CODES
+
+def wait_retry_after(retry_state) -> float:
+    """Respectă întârzierea cerută de server (RetryInfo.retryDelay), dacă aceasta există."""
+    details = getattr(retry_state.outcome.exception(), "details", None) or {}
+    error = details.get("error", details)
+    for detail in error.get("details", []):
+        delay = detail.get("retryDelay")
+        if delay:
+            return float(delay.rstrip("s"))
+    return 0
+
+# --- ROTAȚIA CHEILOR API ---
+# O cheie care a primit 429 este ocolită timp de KEY_COOLDOWN_SECONDS.
+KEY_COOLDOWN_SECONDS = 60
+_key_cycle = itertools.cycle(range(len(clients)))
+_key_cooling_until = [0.0] * len(clients)
+
+def next_client_index():
+    """Următoarea cheie din rotație care nu este în pauză (sau cea care iese prima din pauză)."""
+    now = time.monotonic()
+    for _ in range(len(clients)):
+        i = next(_key_cycle)
+        if _key_cooling_until[i] <= now:
+            return i
+    return min(range(len(clients)), key=_key_cooling_until.__getitem__)
+
+def mark_key_cooling(i):
+    """Pune cheia în pauză după un 429."""
+    _key_cooling_until[i] = time.monotonic() + KEY_COOLDOWN_SECONDS
+
+@retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_combine(wait_retry_after, wait_random_exponential(multiplier=1, max=60)),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def generate_with_retry(image_files):
+    """
+    Trimite prompt-ul și imaginile către Gemini, reîncercând automat când limita de rată
+    este depășită. Fiecare încercare alege o cheie nouă din rotație.
+    """
+    i = next_client_index()
+
+    try:
+        # Redimensionarea și upload-ul rulează în paralel, în thread-uri; imaginile deja
+        # încărcate pentru această cheie sunt refolosite prin URI. O eroare de upload oprește
+        # încercarea: analiza nu rulează niciodată pe un set incomplet de imagini.
+        uploaded = await asyncio.gather(*(asyncio.to_thread(upload_image, p, key_index=i) for p in image_files))
+        image_parts = [types.Part.from_uri(file_uri=file_uri, mime_type='image/jpeg') for file_uri in uploaded]
+
+        contents = [PROMPT_TEXT] + image_parts
+        await throttle(contents)
+        return await clients[i].aio.models.generate_content(model=GEMINI_MODEL, contents=contents)
+    except errors.APIError as e:
+        if e.code == 429:
+            mark_key_cooling(i)
+        raise
+
+# --- PREGĂTIREA IMAGINILOR ---
+# Gemini împarte imaginile în tile-uri de 768x768, deci rezoluțiile mai mari doar cresc upload-ul.
+IMAGE_MAX_SIZE = 1024
+IMAGE_JPEG_QUALITY = 85
+IMAGE_CACHE_FOLDER = ".cache_imagini"
+
+def load_and_resize(img_path):
+    """
+    Redimensionează imaginea la maxim 1024px pe latura lungă și o recomprimă ca JPEG.
+    Rezultatul este păstrat în IMAGE_CACHE_FOLDER sub hash-ul conținutului original,
+    astfel încât rulările ulterioare să nu mai refacă procesarea.
+    """
+    with open(img_path, 'rb') as f:
+        raw = f.read()
+    cache_path = os.path.join(IMAGE_CACHE_FOLDER, f"{hashlib.sha256(raw).hexdigest()}.jpg")
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return f.read()
+
+    img = Image.open(io.BytesIO(raw))
+    img.thumbnail((IMAGE_MAX_SIZE, IMAGE_MAX_SIZE), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    data = buf.getvalue()
+
+    os.makedirs(IMAGE_CACHE_FOLDER, exist_ok=True)
+    with open(cache_path, 'wb') as f:
+        f.write(data)
+    return data
+
+# --- REUTILIZAREA FIȘIERELOR ÎNCĂRCATE (Files API) ---
+# Fiecare imagine redimensionată este încărcată o singură dată; URI-ul ei rămâne valabil
+# 48 de ore și este refolosit la reîncercări, la rulări noi și la modificări de prompt.
+UPLOAD_INDEX_PATH = os.path.join(IMAGE_CACHE_FOLDER, "uploads.json")
+_upload_lock = threading.Lock()
+_upload_index = None
+
+def load_upload_index():
+    """Încarcă (o singură dată) indexul {hash_imagine: {name, uri, expira}} de pe disc."""
+    global _upload_index
+    if _upload_index is None:
+        try:
+            with open(UPLOAD_INDEX_PATH, 'r', encoding='utf-8') as f:
+                _upload_index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _upload_index = {}
+    return _upload_index
+
+def upload_image(img_path, min_remaining=timedelta(minutes=30), key_index=0):
+    """
+    Returnează URI-ul Files API al imaginii redimensionate pentru cheia `key_index`,
+    încărcând-o doar dacă nu există deja un upload valabil cel puțin `min_remaining`.
+    """
+    data = load_and_resize(img_path)
+    image_hash = f"{client_ids[key_index]}:{hashlib.sha256(data).hexdigest()}"
+
+    with _upload_lock:
+        entry = load_upload_index().get(image_hash)
+    if entry and datetime.fromisoformat(entry["expira"]) - min_remaining > datetime.now(timezone.utc):
+        return entry["uri"]
+
+    uploaded = clients[key_index].files.upload(
+        file=io.BytesIO(data),
+        config=types.UploadFileConfig(mime_type='image/jpeg'),
+    )
+    expira = uploaded.expiration_time or datetime.now(timezone.utc) + timedelta(hours=48)
+    with _upload_lock:
+        index = load_upload_index()
+        index[image_hash] = {"name": uploaded.name, "uri": uploaded.uri, "expira": expira.isoformat()}
+        os.makedirs(IMAGE_CACHE_FOLDER, exist_ok=True)
+        with open(UPLOAD_INDEX_PATH, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+    return uploaded.uri
+
+def parse_analysis(text):
+    """Curăță eventualele delimitări Markdown și parsează JSON-ul returnat de AI."""
+    cleaned_response = text.strip().replace("```json", "").replace("```", "")
+    return json.loads(cleaned_response)
+
+def list_image_files(location_folder_path):
+    """Returnează căile complete ale imaginilor dintr-un folder de locație."""
+    return [
+        os.path.join(location_folder_path, f)
+        for f in os.listdir(location_folder_path)
+        if f.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+
+# --- CACHE PENTRU ANALIZE ---
+# Aceleași imagini + același model + aceeași versiune de prompt => aceeași analiză.
+# Incrementează PROMPT_VERSION ori de câte ori modifici prompt-ul.
+PROMPT_VERSION = "1"
+ANALYSIS_CACHE_FOLDER = ".cache_analize"
+
+def analysis_cache_key(img_paths):
+    """Cheia cache-ului: hash-urile imaginilor (în ordine sortată), modelul și versiunea prompt-ului."""
+    image_hashes = []
+    for img_path in img_paths:
+        with open(img_path, 'rb') as f:
+            image_hashes.append(hashlib.sha256(f.read()).hexdigest())
+    h = hashlib.sha256()
+    for image_hash in sorted(image_hashes):
+        h.update(image_hash.encode())
+    h.update(f"{GEMINI_MODEL}:{PROMPT_VERSION}".encode())
+    return h.hexdigest()
+
+def read_cached_analysis(cache_key):
+    """Returnează analiza salvată pentru cheia dată sau None dacă nu există."""
+    cache_path = os.path.join(ANALYSIS_CACHE_FOLDER, f"{cache_key}.json")
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_cached_analysis(cache_key, analysis_json):
+    """Salvează analiza pe disc sub cheia dată."""
+    os.makedirs(ANALYSIS_CACHE_FOLDER, exist_ok=True)
+    with open(os.path.join(ANALYSIS_CACHE_FOLDER, f"{cache_key}.json"), 'w', encoding='utf-8') as f:
+        json.dump(analysis_json, f, ensure_ascii=False)
+
+async def analyze_location(location_folder_path):
+    """
+    Analizează toate imaginile dintr-un folder și returnează (JSON cu costurile de renovare, cheia de cache).
+    """
+    folder_name = os.path.basename(location_folder_path)
+
+    print(f"\n🔍 Procesare imagini pentru: {folder_name}")
+    image_files = list_image_files(location_folder_path)
+
+    if not image_files:
+        print(f"⚠️ AVERTISMENT: Nu am găsit imagini în folderul {folder_name}. Sar peste analiza AI.")
+        return None, None
+
+    cache_key = await asyncio.to_thread(analysis_cache_key, image_files)
+    cached_analysis = read_cached_analysis(cache_key)
+    if cached_analysis is not None:
+        print(f"♻️ Analiza pentru {folder_name} a fost găsită în cache. Nu mai apelez AI-ul.")
+        return cached_analysis, cache_key
+
     try:
         print("🤖 Se trimit imaginile către AI pentru analiză... (acest pas poate dura)")
-        response = model.generate_content([prompt_text] + image_parts)
-        
-        cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-        analysis_json = json.loads(cleaned_response)
-        return analysis_json
+        response = await generate_with_retry(image_files)
+        analysis_json = parse_analysis(response.text)
+        write_cached_analysis(cache_key, analysis_json)
+        return analysis_json, cache_key
 
     except Exception as e:
         print(f"❌ EROARE la analiza AI pentru {folder_name}: {e}")
+        return None, None
+
+def read_location_info(folder_name):
+    """
+    Citește 'info.json' din folderul locației și returnează (adresa, lat, long) sau None.
+    """
+    location_path = os.path.join(INPUT_FOLDER, folder_name)
+
+    info_locatie = {}
+    try:
+        with open(os.path.join(location_path, 'info.json'), 'r', encoding='utf-8') as f:
+            info_locatie = json.load(f)
+    except FileNotFoundError:
+        print(f"\n⚠️ AVERTISMENT: Nu am găsit 'info.json' în folderul '{folder_name}'. Se sare peste acest folder.")
         return None
+    except json.JSONDecodeError:
+        print(f"\n❌ EROARE: Fișierul 'info.json' din folderul '{folder_name}' este invalid. Se sare peste.")
+        return None
+
+    adresa = info_locatie.get("adresa", folder_name)
+
+    # --- AICI ESTE MODIFICAREA ---
+    lat = info_locatie.get("latitudine")  # Modificat din "lat"
+    long = info_locatie.get("longitudine") # Modificat din "long"
+    # ---------------------------
+
+    return adresa, lat, long
+
+def build_row(result_json, prompt_hash, folder_name, adresa, lat, long):
+    """Construiește rândul pentru tabela 'locatii' din rezultatul analizei."""
+    data_to_insert = {
+        "json_locatie": result_json,
+        "nume_locatie": adresa,
+        "prompt_hash": prompt_hash,
+        "de_folosit": True
+    }
+
+    if lat is not None and long is not None:
+        data_to_insert['locatie_geo'] = f'POINT({long} {lat})'
+        print(f"📍 Coordonate încărcate pentru {adresa}")
+    else:
+        print(f"⚠️ AVERTISMENT: Coordonate lipsă în 'info.json' pentru '{folder_name}'.")
+
+    return data_to_insert
+
+def fetch_existing_locations(adrese):
+    """Returnează, dintr-o singură interogare, adresele care există deja în Supabase."""
+    if not adrese:
+        return set()
+    response = supabase.table('locatii').select('nume_locatie').in_('nume_locatie', adrese).execute()
+    return {row['nume_locatie'] for row in response.data}
+
+def insert_rows(rows):
+    """
+    Inserează un lot de rânduri în tabela 'locatii' printr-un singur request.
+    Rândurile cu același 'nume_locatie' sunt actualizate, nu duplicate. 'prompt_hash' nu este
+    folosit drept cheie: locații diferite pot avea aceleași poze și același prompt.
+    """
+    unice = {}
+    for row in rows:
+        if row['nume_locatie'] in unice:
+            print(f"⚠️ AVERTISMENT: '{row['nume_locatie']}' apare de mai multe ori în lot. Se păstrează ultima analiză.")
+        unice[row['nume_locatie']] = row
+    rows = list(unice.values())
+    try:
+        supabase.table('locatii').upsert(rows, on_conflict='nume_locatie').execute()
+        print(f"💾 {len(rows)} analize au fost salvate cu succes în Supabase!")
+    except Exception as e:
+        print(f"❌ EROARE la salvarea în Supabase: {e}")
+
+def collect_new_locations(location_folders):
+    """
+    Citește 'info.json' pentru fiecare folder și păstrează doar locațiile care
+    nu există încă în baza de date. Returnează {folder_name: (adresa, lat, long)}.
+    """
+    infos = {}
+    for folder_name in location_folders:
+        info = read_location_info(folder_name)
+        if info is not None:
+            infos[folder_name] = info
+
+    existing = fetch_existing_locations([adresa for adresa, _, _ in infos.values()])
+    new_locations = {}
+    for folder_name, info in infos.items():
+        if info[0] in existing:
+            print(f"\n✅ Locația '{info[0]}' există deja în baza de date. Se sare peste.")
+        else:
+            new_locations[folder_name] = info
+    return new_locations
+
+def list_location_folders():
+    """Returnează subfolderele din INPUT_FOLDER (câte unul pentru fiecare locație)."""
+    return [d for d in os.listdir(INPUT_FOLDER) if os.path.isdir(os.path.join(INPUT_FOLDER, d))]
+
+# --- 3. MODUL INTERACTIV (cereri sincrone, câte una per locație) ---
+async def process_location(folder_name, info, semaphore):
+    """
+    Rulează analiza AI pentru o locație și returnează rândul de inserat (sau None).
+    """
+    adresa, lat, long = info
+
+    async with semaphore:
+        result_json, prompt_hash = await analyze_location(os.path.join(INPUT_FOLDER, folder_name))
+
+    if result_json:
+        return build_row(result_json, prompt_hash, folder_name, adresa, lat, long)
+    return None
+
+
+async def main_interactive():
+    location_folders = list_location_folders()
+
+    print(f"Am găsit {len(location_folders)} locații de procesat.")
+
+    # Apelurile Supabase sunt sincrone, așa că le rulăm într-un thread separat
+    new_locations = await asyncio.to_thread(collect_new_locations, location_folders)
+
+    # Toate locațiile pornesc simultan; semaforul limitează cererile active către Gemini
+    semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    tasks = [asyncio.create_task(process_location(name, info, semaphore)) for name, info in new_locations.items()]
+
+    pending = []
+    for task in tqdm.as_completed(tasks, desc="Progres total"):
+        row = await task
+        if row:
+            pending.append(row)
+        if len(pending) >= INSERT_BATCH_SIZE:
+            await asyncio.to_thread(insert_rows, pending)
+            pending = []
+    if pending:
+        await asyncio.to_thread(insert_rows, pending)
 
-# --- 3. EXECUȚIA PRINCIPALĂ ---
+    print("\n🎉 Analiză finalizată pentru toate locațiile!")
+
+# --- 4. MODUL BATCH (un singur job Gemini Batch API pentru toate locațiile) ---
+def build_batch_request(adresa, image_files):
+    """
+    Încarcă imaginile locației prin Files API și construiește o linie JSONL pentru job-ul batch.
+    Imaginile sunt referite prin URI, ca să nu depășim limita de 20MB pentru date inline.
+    """
+    @retry(
+        retry=retry_if_exception(is_retryable),
+        wait=wait_combine(wait_retry_after, wait_random_exponential(multiplier=1, max=60)),
+        stop=stop_after_attempt(6),
+        reraise=True,
+    )
+    def resize_and_upload(img_path):
+        # Job-ul batch poate dura până la 24 de ore, deci URI-ul trebuie să fie valabil cel puțin atât
+        return upload_image(img_path, min_remaining=BATCH_UPLOAD_MIN_REMAINING)
+
+    # Redimensionarea și upload-ul imaginilor rulează în paralel; dacă o imagine nu poate fi
+    # încărcată nici după reîncercări, eroarea ajunge la apelant și locația este sărită
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        file_uris = list(executor.map(resize_and_upload, image_files))
+
+    parts = [{"text": PROMPT_TEXT}]
+    for file_uri in file_uris:
+        parts.append({"file_data": {"file_uri": file_uri, "mime_type": 'image/jpeg'}})
+
+    return {"key": adresa, "request": {"contents": [{"role": "user", "parts": parts}]}}
+
+def run_batch_job(batch_requests):
+    """
+    Trimite toate cererile ca un singur job batch, așteaptă finalizarea și
+    returnează un dicționar {adresa: analiza_json}.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False, encoding='utf-8') as f:
+        for request in batch_requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+        jsonl_path = f.name
+
+    try:
+        src_file = client.files.upload(
+            file=jsonl_path,
+            config=types.UploadFileConfig(display_name='analiza-locatii', mime_type='jsonl'),
+        )
+    finally:
+        os.remove(jsonl_path)
+
+    job = client.batches.create(model=GEMINI_MODEL, src=src_file.name, config={'display_name': 'analiza-locatii'})
+    print(f"📦 Job batch creat: {job.name}")
+
+    delay = BATCH_POLL_INITIAL_SECONDS
+    while job.state.name not in BATCH_FINAL_STATES:
+        print(f"⏳ Stare job: {job.state.name}. Verific din nou peste {delay} secunde...")
+        time.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+        job = client.batches.get(name=job.name)
+
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        print(f"❌ EROARE: Job-ul batch s-a încheiat cu starea {job.state.name}: {job.error}")
+        return {}
+
+    results = {}
+    output = client.files.download(file=job.dest.file_name).decode('utf-8')
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        adresa = item.get("key")
+        if "error" in item:
+            print(f"❌ EROARE la analiza AI pentru {adresa}: {item['error']}")
+            continue
+        try:
+            parts = item["response"]["candidates"][0]["content"]["parts"]
+            text = "".join(part.get("text", "") for part in parts if not part.get("thought"))
+            results[adresa] = parse_analysis(text)
+        except Exception as e:
+            print(f"❌ EROARE la parsarea răspunsului pentru {adresa}: {e}")
+    return results
+
+def main_batch():
+    location_folders = list_location_folders()
+
+    print(f"Am găsit {len(location_folders)} locații de procesat.")
+
+    rows = []
+    pending = {}
+    batch_requests = []
+    new_locations = collect_new_locations(location_folders)
+    for folder_name, (adresa, lat, long) in tqdm(new_locations.items(), desc="Pregătire batch"):
+        image_files = list_image_files(os.path.join(INPUT_FOLDER, folder_name))
+        if not image_files:
+            print(f"⚠️ AVERTISMENT: Nu am găsit imagini pentru '{adresa}'. Sar peste analiza AI.")
+            continue
+
+        # Locațiile deja analizate (aceleași imagini) nu mai intră în job-ul batch
+        cache_key = analysis_cache_key(image_files)
+        cached_analysis = read_cached_analysis(cache_key)
+        if cached_analysis is not None:
+            print(f"♻️ Analiza pentru '{adresa}' a fost găsită în cache. Nu mai apelez AI-ul.")
+            rows.append(build_row(cached_analysis, cache_key, folder_name, adresa, lat, long))
+            continue
+
+        try:
+            batch_requests.append(build_batch_request(adresa, image_files))
+        except Exception as e:
+            print(f"❌ EROARE: Nu am putut încărca imaginile pentru '{adresa}' ({e}). Locația nu intră în job-ul batch.")
+            continue
+        pending[adresa] = (cache_key, folder_name, lat, long)
+
+    results = run_batch_job(batch_requests) if batch_requests else {}
+
+    for adresa, result_json in results.items():
+        if adresa in pending:
+            cache_key, folder_name, lat, long = pending[adresa]
+            write_cached_analysis(cache_key, result_json)
+            rows.append(build_row(result_json, cache_key, folder_name, adresa, lat, long))
+
+    if not rows:
+        print("\nNu există locații noi de analizat.")
+        return
+
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        insert_rows(rows[i:i + INSERT_BATCH_SIZE])
+
+    print("\n🎉 Analiză finalizată pentru toate locațiile!")
+
+# --- 5. EXECUȚIA PRINCIPALĂ ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analizează locațiile din folderul de intrare cu Gemini.")
+    parser.add_argument(
+        "--interactive",
+        action="store_true",
+        help="Trimite câte o cerere sincronă per locație în loc de un job Batch API.",
+    )
+    args = parser.parse_args()
+
     if not os.path.isdir(INPUT_FOLDER):
         print(f"❌ EROARE: Folderul de intrare '{INPUT_FOLDER}' nu există.")
+    elif args.interactive:
+        asyncio.run(main_interactive())
     else:
-        location_folders = [d for d in os.listdir(INPUT_FOLDER) if os.path.isdir(os.path.join(INPUT_FOLDER, d))]
-        
-        print(f"Am găsit {len(location_folders)} locații de procesat.")
-        
-        for folder_name in tqdm(location_folders, desc="Progres total"):
-            location_path = os.path.join(INPUT_FOLDER, folder_name)
-            
-            info_locatie = {}
-            try:
-                with open(os.path.join(location_path, 'info.json'), 'r', encoding='utf-8') as f:
-                    info_locatie = json.load(f)
-            except FileNotFoundError:
-                print(f"\n⚠️ AVERTISMENT: Nu am găsit 'info.json' în folderul '{folder_name}'. Se sare peste acest folder.")
-                continue
-            except json.JSONDecodeError:
-                print(f"\n❌ EROARE: Fișierul 'info.json' din folderul '{folder_name}' este invalid. Se sare peste.")
-                continue
-
-            adresa = info_locatie.get("adresa", folder_name)
-            
-            # --- AICI ESTE MODIFICAREA ---
-            lat = info_locatie.get("latitudine")  # Modificat din "lat"
-            long = info_locatie.get("longitudine") # Modificat din "long"
-            # ---------------------------
-            
-            response = supabase.table('locatii').select('id', count='exact').eq('nume_locatie', adresa).execute()
-            if response.count > 0:
-                print(f"\n✅ Locația '{adresa}' există deja în baza de date. Se sare peste.")
-                continue
-
-            result_json = analyze_location(location_path)
-            
-            if result_json:
-                try:
-                    data_to_insert = {
-                        "json_locatie": result_json,
-                        "nume_locatie": adresa,
-                        "de_folosit": True
-                    }
-                    
-                    if lat is not None and long is not None:
-                        data_to_insert['locatie_geo'] = f'POINT({long} {lat})'
-                        print(f"📍 Coordonate încărcate pentru {adresa}")
-                    else:
-                        print(f"⚠️ AVERTISMENT: Coordonate lipsă în 'info.json' pentru '{folder_name}'.")
-
-                    supabase.table('locatii').insert(data_to_insert).execute()
-                    print(f"💾 Analiza pentru '{adresa}' a fost salvată cu succes în Supabase!")
-                except Exception as e:
-                    print(f"❌ EROARE la salvarea în Supabase pentru {adresa}: {e}")
-
-        print("\n🎉 Analiză finalizată pentru toate locațiile!")
\ No newline at end of file
+        main_batch()
@@ -1,10 +1,22 @@
-import json
+import aiofiles
+import orjson
 import asyncio
+import bisect
+import math
 import google.generativeai as genai
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServiceUnavailable
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+import uvicorn
 import os
-from typing import Dict, List
+import sys
+from typing import Dict, List, Optional
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_combine, wait_random_exponential
+
+# Extragerea bugetului din cerință, comună cu celelalte versiuni ale consultantului
+from buget import extract_budget_eur
 
 # --- 1. CONFIGURARE ---
 try:
@@ -24,26 +36,126 @@ class UserRequest(BaseModel):
     cerinta_user: str
 
 # --- 3. LOGICA DE BAZĂ ---
-def load_all_json_data() -> Dict[str, dict]:
-    """Încarcă toate analizele JSON într-un dicționar pentru acces rapid."""
+# Analizele parsate și contextul serializat pentru AI rămân în memorie până când
+# se modifică fișierele din JSON_FOLDER (adăugare, ștergere sau editare).
+_CACHE = {"fingerprint": None, "data": {}, "context": "", "sorted_names": [], "budget_costs": [], "budget_names": []}
+
+def json_folder_fingerprint() -> tuple:
+    """Amprenta folderului: numele și mtime-ul fiecărui fișier JSON (doar stat, fără citire)."""
+    with os.scandir(JSON_FOLDER) as entries:
+        return tuple(sorted(
+            (entry.name, entry.stat().st_mtime_ns) for entry in entries if entry.name.endswith(".json")
+        ))
+
+def build_ai_context(all_data: Dict[str, dict]) -> str:
+    """Contextul pentru AI: doar numele și costul fiecărei proprietăți, serializate compact."""
+    slim = [
+        {"nume_locatie": data["nume_locatie"], "cost_estimat_total_eur": data.get("cost_estimat_total_eur", 0)}
+        for data in all_data.values()
+    ]
+    return orjson.dumps(slim, option=orjson.OPT_NON_STR_KEYS).decode()
+
+def build_cost_index(all_data: Dict[str, dict]) -> None:
+    """
+    Precalculează ordinea după cost a proprietăților, ca endpoint-ul să nu mai sorteze la
+    fiecare cerere: toate numele (cost lipsă = 0) și, separat, doar cele cu cost numeric,
+    împreună cu costurile lor crescătoare pentru căutarea binară după buget.
+    """
+    _CACHE["sorted_names"] = sorted(all_data, key=lambda name: all_data[name].get("cost_estimat_total_eur", 0))
+    priced = [
+        (all_data[name]["cost_estimat_total_eur"], name) for name in _CACHE["sorted_names"]
+        if isinstance(all_data[name].get("cost_estimat_total_eur"), (int, float))
+    ]
+    _CACHE["budget_costs"] = [cost for cost, _ in priced]
+    _CACHE["budget_names"] = [name for _, name in priced]
+
+async def read_json_file(file_path: str) -> Optional[dict]:
+    """Citește și parsează un fișier JSON fără să blocheze event loop-ul (None dacă e invalid)."""
+    try:
+        async with aiofiles.open(file_path, 'rb') as f:
+            return orjson.loads(await f.read())
+    except Exception:
+        return None
+
+async def load_all_json_data() -> Dict[str, dict]:
+    """Încarcă toate analizele JSON într-un dicționar pentru acces rapid (din cache dacă nimic nu s-a schimbat)."""
     all_data = {}
     if not os.path.isdir(JSON_FOLDER):
         return {}
 
-    for filename in os.listdir(JSON_FOLDER):
-        if filename.endswith(".json"):
-            location_name = filename.replace(".json", "")
-            file_path = os.path.join(JSON_FOLDER, filename)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Creăm un nou dicționar cu 'nume_locatie' la început
-                    ordered_data = {'nume_locatie': location_name, **data}
-                    all_data[location_name] = ordered_data
-            except Exception:
-                continue
+    fingerprint = json_folder_fingerprint()
+    if fingerprint == _CACHE["fingerprint"]:
+        return _CACHE["data"]
+
+    # Fișierele sunt citite concurent, apoi asamblate în ordinea din folder
+    filenames = [filename for filename, _ in fingerprint]
+    contents = await asyncio.gather(
+        *(read_json_file(os.path.join(JSON_FOLDER, filename)) for filename in filenames)
+    )
+    for filename, data in zip(filenames, contents):
+        if not isinstance(data, dict):
+            continue
+        location_name = filename.replace(".json", "")
+        # Creăm un nou dicționar cu 'nume_locatie' la început
+        all_data[location_name] = {'nume_locatie': location_name, **data}
+
+    _CACHE["fingerprint"] = fingerprint
+    _CACHE["data"] = all_data
+    _CACHE["context"] = build_ai_context(all_data)
+    build_cost_index(all_data)
     return all_data
 
+# --- PRE-FILTRARE DUPĂ BUGET (fără AI) ---
+def filter_by_budget(all_locations_dict: Dict[str, dict], buget_eur: float) -> List[dict]:
+    """Returnează, ordonate după cost, proprietățile al căror cost de renovare se încadrează în buget."""
+    end = bisect.bisect_right(_CACHE["budget_costs"], buget_eur)
+    return [all_locations_dict[name] for name in _CACHE["budget_names"][:end]]
+
+# --- LIMITARE PROACTIVĂ A RATEI (RPM / TPM) ---
+# Limitatoarele sunt globale, deci toate corutinele din proces împart aceeași cotă.
+# Fiecare worker uvicorn are propriile limitatoare, deci cota totală este împărțită la WORKERS
+# (aceeași valoare ca în __main__; la pornirea din CLI cu --workers N, setează și WORKERS=N).
+WORKERS = int(os.getenv("WORKERS", "1"))
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+IMAGE_TOKENS = 258  # costul fix al unei imagini (un tile de 768x768)
+
+rpm_limiter = AsyncLimiter(max(GEMINI_RPM // WORKERS, 1), 60)
+tpm_limiter = AsyncLimiter(max(GEMINI_TPM // 1000 // WORKERS, 1), 60)  # un permis = 1000 de tokeni
+
+def estimate_tokens(contents):
+    """Estimare grosieră a tokenilor de intrare: ~4 caractere per token, 258 per imagine."""
+    if isinstance(contents, str):
+        contents = [contents]
+    return sum(len(part) // 4 if isinstance(part, str) else IMAGE_TOKENS for part in contents)
+
+async def throttle(contents):
+    """Așteaptă până când cererea încape atât în limita RPM, cât și în cea TPM."""
+    permits = math.ceil(estimate_tokens(contents) / 1000)
+    await tpm_limiter.acquire(min(max(permits, 1), tpm_limiter.max_rate))
+    await rpm_limiter.acquire()
+
+# --- REÎNCERCĂRI LA ERORI TEMPORARE (429 / 503 / 504) ---
+def wait_retry_after(retry_state):
+    """Respectă întârzierea cerută de server (RetryInfo), dacă aceasta există."""
+    exc = retry_state.outcome.exception()
+    for detail in getattr(exc, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return 0
+
+@retry(
+    retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable, DeadlineExceeded)),
+    wait=wait_combine(wait_retry_after, wait_random_exponential(multiplier=1, max=60)),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def generate_with_retry(model, contents):
+    """Trimite cererea către Gemini, reîncercând automat când limita de rată este depășită."""
+    await throttle(contents)
+    return await model.generate_content_async(contents)
+
 async def select_matching_locations_with_ai(cerinta_user: str, context_data: str) -> str:
     """
     Face un AI call pentru a selecta numele TUTUROR locațiilor potrivite.
@@ -70,24 +182,29 @@ async def select_matching_locations_with_ai(cerinta_user: str, context_data: str
     """
     try:
         model = genai.GenerativeModel('gemini-2.5-flash')
-        response = await model.generate_content_async(prompt)
+        response = await generate_with_retry(model, prompt)
         return response.text.strip()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"A apărut o eroare la selecția AI: {e}")
 
 # --- 4. ENDPOINT-UL API ---
-@app.post("/recomandari-multiple-json", response_model=Dict[str, List[dict]])
+@app.post("/recomandari-multiple-json", response_class=ORJSONResponse)
 async def get_json_recommendations_endpoint(request: UserRequest):
     """
     Primește cerința utilizatorului și returnează o listă cu analizele JSON complete
     pentru TOATE proprietățile potrivite, selectate de AI.
     """
     # Pas 1: Încarcă datele din fișierele JSON
-    all_locations_dict = load_all_json_data()
+    all_locations_dict = await load_all_json_data()
     if not all_locations_dict:
         raise HTTPException(status_code=404, detail="Nicio analiză JSON nu a fost găsită.")
 
-    context_for_ai = json.dumps(list(all_locations_dict.values()), indent=2, ensure_ascii=False)
+    # Când bugetul poate fi citit direct din cerere, comparația se face în cod, fără AI
+    buget_eur = extract_budget_eur(request.cerinta_user)
+    if buget_eur is not None:
+        return {"rezultate": filter_by_budget(all_locations_dict, buget_eur)}
+
+    context_for_ai = _CACHE["context"]
     
     # Pas 2: Obține numele locațiilor selectate de la AI (string separat prin virgulă)
     selected_locations_string = await select_matching_locations_with_ai(
@@ -99,16 +216,26 @@ async def get_json_recommendations_endpoint(request: UserRequest):
     if selected_locations_string == "N/A":
         return {"rezultate": []}
 
-    # Transformă string-ul "Locatie1,Locatie2" în lista ["Locatie1", "Locatie2"]
-    location_names_list = selected_locations_string.split(',')
-    
-    matching_jsons = []
-    for name in location_names_list:
-        if name in all_locations_dict:
-            matching_jsons.append(all_locations_dict[name])
-            
-    # Sortează rezultatele final de la cel mai ieftin la cel mai scump
-    sorted_results = sorted(matching_jsons, key=lambda x: x.get("cost_estimat_total_eur", 0))
+    # Transformă string-ul "Locatie1,Locatie2" în mulțimea {"Locatie1", "Locatie2"}
+    chosen = set(selected_locations_string.split(','))
+
+    # Parcurge numele deja ordonate de la cel mai ieftin la cel mai scump, fără sortare per cerere
+    sorted_results = [all_locations_dict[name] for name in _CACHE["sorted_names"] if name in chosen]
 
     return {"rezultate": sorted_results}
 
+# --- 5. PORNIREA SERVERULUI ---
+# Echivalent cu: uvicorn script2_consultant_aiV1:app --loop uvloop --http httptools --workers 1 --limit-concurrency 200
+# Cu WORKERS > 1, limitele RPM/TPM se împart între workeri, dar cache-urile din memorie nu sunt comune.
+if __name__ == "__main__":
+    print("--- Serverul pornește ---")
+    print("Accesează documentația API la adresa: http://127.0.0.1:8000/docs")
+    uvicorn.run(
+        "script2_consultant_aiV1:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",  # uvloop nu există pe Windows
+        http="httptools",
+        workers=WORKERS,
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "200")),
+    )
@@ -1,15 +1,27 @@
+import aiofiles
 import asyncio
-import json
+import bisect
+import orjson
+import math
 import os
-from typing import Dict, List
+import sys
+import time
+from typing import Dict, List, Optional
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+import uvicorn
 
 # Import the new library and its types
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_combine, wait_random_exponential
+
+# Extragerea bugetului din cerință, comună cu celelalte versiuni ale consultantului
+from buget import extract_budget_eur
 
 # --- 1. NEW SDK CONFIGURATION ---
 load_dotenv()
@@ -37,54 +49,169 @@ app.add_middleware(
 class UserRequest(BaseModel):
     cerinta_user: str
 
-def load_all_json_data(output_filename: str = "concatenated_results.json") -> Dict[str, dict]:
+# Analizele parsate și contextul serializat pentru AI rămân în memorie până când
+# se modifică fișierele din JSON_FOLDER (adăugare, ștergere sau editare).
+_CACHE = {"fingerprint": None, "data": {}, "context": "", "sorted_names": [], "budget_costs": [], "budget_names": []}
+
+def json_folder_fingerprint(output_filename: str) -> tuple:
+    """Amprenta folderului: numele și mtime-ul fiecărui fișier JSON (doar stat, fără citire)."""
+    with os.scandir(JSON_FOLDER) as entries:
+        return tuple(sorted(
+            (entry.name, entry.stat().st_mtime_ns)
+            for entry in entries
+            if entry.name.endswith(".json") and entry.name != output_filename
+        ))
+
+def build_ai_context(all_data: Dict[str, dict]) -> str:
+    """Contextul pentru AI: doar numele și costul fiecărei proprietăți, serializate compact."""
+    slim = [
+        {"nume_locatie": data["nume_locatie"], "cost_estimat_total_eur": data.get("cost_estimat_total_eur", 0)}
+        for data in all_data.values()
+    ]
+    return orjson.dumps(slim, option=orjson.OPT_NON_STR_KEYS).decode()
+
+def build_cost_index(all_data: Dict[str, dict]) -> None:
+    """
+    Precalculează ordinea după cost a proprietăților, ca endpoint-ul să nu mai sorteze la
+    fiecare cerere: toate numele (cost lipsă = 0) și, separat, doar cele cu cost numeric,
+    împreună cu costurile lor crescătoare pentru căutarea binară după buget.
+    """
+    _CACHE["sorted_names"] = sorted(all_data, key=lambda name: all_data[name].get("cost_estimat_total_eur", 0))
+    priced = [
+        (all_data[name]["cost_estimat_total_eur"], name) for name in _CACHE["sorted_names"]
+        if isinstance(all_data[name].get("cost_estimat_total_eur"), (int, float))
+    ]
+    _CACHE["budget_costs"] = [cost for cost, _ in priced]
+    _CACHE["budget_names"] = [name for _, name in priced]
+
+async def read_json_file(file_path: str) -> Optional[dict]:
+    """Citește și parsează un fișier JSON fără să blocheze event loop-ul (None dacă e invalid)."""
+    try:
+        async with aiofiles.open(file_path, 'rb') as f:
+            return orjson.loads(await f.read())
+    except Exception:
+        return None
+
+async def load_all_json_data(output_filename: str = "concatenated_results.json") -> Dict[str, dict]:
     """
     Încarcă toate analizele JSON într-un dicționar, le salvează într-un singur
-    fișier JSON și returnează dicționarul.
+    fișier JSON și returnează dicționarul. Dacă fișierele nu s-au schimbat de la
+    ultimul apel, returnează direct datele din memorie, fără citire sau rescriere.
     """
     all_data = {}
     if not os.path.isdir(JSON_FOLDER):
         os.makedirs(JSON_FOLDER, exist_ok=True)
         return {}
 
-    for filename in os.listdir(JSON_FOLDER):
-        if filename.endswith(".json") and filename != output_filename:
-            location_name = filename.replace(".json", "")
-            file_path = os.path.join(JSON_FOLDER, filename)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    ordered_data = {'nume_locatie': location_name, **data}
-                    all_data[location_name] = ordered_data
-            except Exception:
-                continue
+    fingerprint = json_folder_fingerprint(output_filename)
+    if fingerprint == _CACHE["fingerprint"]:
+        return _CACHE["data"]
 
+    # Fișierele sunt citite concurent, apoi asamblate în ordinea din folder
+    filenames = [filename for filename, _ in fingerprint]
+    contents = await asyncio.gather(
+        *(read_json_file(os.path.join(JSON_FOLDER, filename)) for filename in filenames)
+    )
+    for filename, data in zip(filenames, contents):
+        if not isinstance(data, dict):
+            continue
+        location_name = filename.replace(".json", "")
+        all_data[location_name] = {'nume_locatie': location_name, **data}
+
+    # Fișierul concatenat se rescrie doar când datele s-au schimbat
     if all_data:
         output_path = os.path.join(JSON_FOLDER, output_filename)
         try:
             data_to_save = list(all_data.values())
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(data_to_save, f, ensure_ascii=False, indent=4)
+            async with aiofiles.open(output_path, 'wb') as f:
+                await f.write(orjson.dumps(data_to_save, option=orjson.OPT_INDENT_2))
         except Exception as e:
             print(f"Eroare la salvarea fișierului concatenat: {e}")
 
+    _CACHE["fingerprint"] = fingerprint
+    _CACHE["data"] = all_data
+    _CACHE["context"] = build_ai_context(all_data)
+    build_cost_index(all_data)
     return all_data
 
-# --- 3. COMPLETELY REWRITTEN AI FUNCTION ---
-async def select_matching_locations_with_ai(cerinta_user: str, context_data: str) -> str:
+# --- PRE-FILTRARE DUPĂ BUGET (fără AI) ---
+def filter_by_budget(all_locations_dict: Dict[str, dict], buget_eur: float) -> List[dict]:
+    """Returnează, ordonate după cost, proprietățile al căror cost de renovare se încadrează în buget."""
+    end = bisect.bisect_right(_CACHE["budget_costs"], buget_eur)
+    return [all_locations_dict[name] for name in _CACHE["budget_names"][:end]]
+
+# --- LIMITARE PROACTIVĂ A RATEI (RPM / TPM) ---
+# Limitatoarele sunt globale, deci toate corutinele din proces împart aceeași cotă.
+# Fiecare worker uvicorn are propriile limitatoare, deci cota totală este împărțită la WORKERS
+# (aceeași valoare ca în __main__; la pornirea din CLI cu --workers N, setează și WORKERS=N).
+WORKERS = int(os.getenv("WORKERS", "1"))
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "5"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+IMAGE_TOKENS = 258  # costul fix al unei imagini (un tile de 768x768)
+
+rpm_limiter = AsyncLimiter(max(GEMINI_RPM // WORKERS, 1), 60)
+tpm_limiter = AsyncLimiter(max(GEMINI_TPM // 1000 // WORKERS, 1), 60)  # un permis = 1000 de tokeni
+
+def estimate_tokens(contents):
+    """Estimare grosieră a tokenilor de intrare: ~4 caractere per token, 258 per imagine."""
+    if isinstance(contents, str):
+        contents = [contents]
+    return sum(len(part) // 4 if isinstance(part, str) else IMAGE_TOKENS for part in contents)
+
+async def throttle(contents):
+    """Așteaptă până când cererea încape atât în limita RPM, cât și în cea TPM."""
+    permits = math.ceil(estimate_tokens(contents) / 1000)
+    await tpm_limiter.acquire(min(max(permits, 1), tpm_limiter.max_rate))
+    await rpm_limiter.acquire()
+
+# --- REÎNCERCĂRI LA ERORI TEMPORARE (429 / 503 / 504) ---
+RETRYABLE_STATUS_CODES = {429, 503, 504}
+
+def is_retryable(exc: BaseException) -> bool:
+    """Doar limitarea de rată și indisponibilitatea temporară merită reîncercate."""
+    return isinstance(exc, errors.APIError) and exc.code in RETRYABLE_STATUS_CODES
+
+def wait_retry_after(retry_state) -> float:
+    """Respectă întârzierea cerută de server (RetryInfo.retryDelay), dacă aceasta există."""
+    details = getattr(retry_state.outcome.exception(), "details", None) or {}
+    error = details.get("error", details)
+    for detail in error.get("details", []):
+        delay = detail.get("retryDelay")
+        if delay:
+            return float(delay.rstrip("s"))
+    return 0
+
+@retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_combine(wait_retry_after, wait_random_exponential(multiplier=1, max=60)),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def generate_first_line_with_retry(**kwargs) -> str:
     """
-    Face un AI call folosind NOUL SDK pentru a selecta numele TUTUROR locațiilor potrivite.
+    Trimite cererea către Gemini în mod streaming și returnează prima linie a răspunsului,
+    oprind generarea imediat ce apare un rând nou. Reîncearcă automat la depășirea limitei de rată.
     """
-    # The prompt remains the most powerful tool to get the model to "think".
-    prompt = f"""
-    Acționează ca un asistent expert în analiză financiară și imobiliară.
+    await throttle(kwargs["contents"])
+    buffer = ""
+    stream = await client.aio.models.generate_content_stream(**kwargs)
+    try:
+        async for chunk in stream:
+            buffer += chunk.text or ""
+            if "\n" in buffer.lstrip():
+                break
+    finally:
+        await stream.aclose()
+    return buffer.strip().split("\n", 1)[0]
 
-    CONTEXT: Ai primit o listă de proprietăți în format JSON. Fiecare are un 'nume_locatie' și un 'cost_estimat_total_eur'.
-    ---
-    {context_data}
-    ---
+# --- 3. COMPLETELY REWRITTEN AI FUNCTION ---
+SELECTION_MODEL = 'gemini-2.5-pro'
+
+# The prompt remains the most powerful tool to get the model to "think".
+SELECTION_INSTRUCTIONS = """
+    Acționează ca un asistent expert în analiză financiară și imobiliară.
 
-    CERINȚA UTILIZATORULUI: "{cerinta_user}"
+    Vei primi o listă de proprietăți în format JSON (CONTEXT), urmată de CERINȚA UTILIZATORULUI.
 
     MISIUNEA TA DETALIATĂ:
     1.  Raționament Inițial: Privește cerința utilizatorului și extrage cu precizie bugetul numeric maxim disponibil pentru renovare. Transforma folosind un curs echitabil daca utilizatorul vorbeste in alta moneda.
@@ -97,60 +224,114 @@ async def select_matching_locations_with_ai(cerinta_user: str, context_data: str
     Exemplu de răspuns valid pentru o selecție reușită:
     Locatie2,Locatie4,Locatie7
     """
-    
+
+def build_context_prompt(context_data: str) -> str:
+    """Partea din prompt care conține lista de proprietăți (se schimbă doar la reîncărcarea JSON-urilor)."""
+    return f"""
+    CONTEXT: Ai primit o listă de proprietăți în format JSON. Fiecare are un 'nume_locatie' și un 'cost_estimat_total_eur'.
+    ---
+    {context_data}
+    ---
+    """
+
+# --- CACHE DE CONTEXT GEMINI ---
+# Instrucțiunile și lista de proprietăți sunt identice între cereri, deci sunt păstrate pe
+# server ca prefix reutilizabil; fiecare cerere trimite doar cerința utilizatorului.
+# Dacă prefixul e prea scurt pentru cache (sub minimul de tokeni al modelului) sau crearea
+# eșuează, cererile trimit promptul complet, ca înainte.
+CONTEXT_CACHE_TTL_SECONDS = 3600
+CONTEXT_CACHE_GRACE_SECONDS = 300  # cât mai trăiește cache-ul vechi după schimbarea contextului
+_context_cache = {"context": None, "name": None, "expira": 0.0}
+_context_cache_lock = asyncio.Lock()
+
+async def get_cached_content(context_data: str) -> Optional[str]:
+    """Returnează numele cache-ului Gemini pentru contextul curent, recreându-l când e nevoie."""
+    async with _context_cache_lock:
+        if _context_cache["context"] == context_data and (
+            _context_cache["name"] is None or time.monotonic() < _context_cache["expira"]
+        ):
+            return _context_cache["name"]
+
+        old_name = _context_cache["name"]
+        _context_cache.update(context=context_data, name=None, expira=0.0)
+        if old_name:
+            # Cache-ul vechi nu este șters: cererile aflate încă în curs îl folosesc. TTL-ul lui este
+            # doar scurtat la CONTEXT_CACHE_GRACE_SECONDS, ca să nu plătim stocarea până la expirarea inițială.
+            try:
+                await client.aio.caches.update(
+                    name=old_name,
+                    config=types.UpdateCachedContentConfig(ttl=f"{CONTEXT_CACHE_GRACE_SECONDS}s"),
+                )
+            except Exception:
+                pass  # cache-ul vechi expiră oricum singur
+
+        try:
+            cache = await client.aio.caches.create(
+                model=SELECTION_MODEL,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=SELECTION_INSTRUCTIONS,
+                    contents=[build_context_prompt(context_data)],
+                    ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s",
+                ),
+            )
+        except Exception:
+            return None
+        # Cache-ul se recreează cu un minut înainte de expirare
+        _context_cache.update(name=cache.name, expira=time.monotonic() + CONTEXT_CACHE_TTL_SECONDS - 60)
+        return cache.name
+
+async def select_matching_locations_with_ai(cerinta_user: str, context_data: str) -> str:
+    """
+    Face un AI call folosind NOUL SDK pentru a selecta numele TUTUROR locațiilor potrivite.
+    """
+    user_prompt = f'CERINȚA UTILIZATORULUI: "{cerinta_user}"'
+    cached_content = await get_cached_content(context_data)
 
     try:
         # The new SDK uses a 'config' object passed directly to the method.
+        # Filtrarea după buget e o comparație simplă: gemini-2.5-pro nu permite dezactivarea
+        # raționamentului, așa că îl limităm la minimul acceptat și nu cerem gândurile înapoi.
         config = types.GenerateContentConfig(
-            max_output_tokens=81920,
+            max_output_tokens=1024,
             temperature=0.0,
-            thinking_config=types.ThinkingConfig(thinking_budget=-1, include_thoughts=True)
-
-            
+            thinking_config=types.ThinkingConfig(thinking_budget=128, include_thoughts=False)
         )
+        if cached_content:
+            config.cached_content = cached_content
+            contents = user_prompt
+        else:
+            config.system_instruction = SELECTION_INSTRUCTIONS
+            contents = [build_context_prompt(context_data), user_prompt]
 
-        # The new async call structure: client.aio.models.generate_content
-        response = await client.aio.models.generate_content(
-            model='gemini-2.5-pro',  # Using a modern model name
-            contents=prompt,
+        # Răspunsul util e o singură linie, deci streaming-ul se oprește la primul rând nou
+        first_line = await generate_first_line_with_retry(
+            model=SELECTION_MODEL,
+            contents=contents,
             config=config
         )
-        
-        
-        # --- NEW LOGIC BASED ON THE DOCUMENTATION ---
-        final_answer_parts = []
-        print("\n--- 🧠 AI's Interleaved Thoughts & Answer ---")
-
-        for part in response.candidates[0].content.parts:
-            # Check if the part is a "thought"
-            if hasattr(part, 'thought') and part.thought:
-                print(f"\n[THOUGHT]:\n{part.text}")
-            # Otherwise, it's part of the final answer
-            else:
-                final_answer_parts.append(part.text)
-        
-        print("------------------------------------------\n")
-
-        # Join the collected answer parts to form the final response
-        final_answer = "".join(final_answer_parts)
-        return final_answer.strip()
+        return first_line.strip()
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"A apărut o eroare la selecția AI: {e}")
 
 
 # --- 4. ENDPOINT-UL API (No changes needed here) ---
-@app.post("/recomandari-multiple-json", response_model=Dict[str, List[dict]])
+@app.post("/recomandari-multiple-json", response_class=ORJSONResponse)
 async def get_json_recommendations_endpoint(request: UserRequest):
     """
     Primește cerința utilizatorului și returnează o listă cu analizele JSON complete
     pentru TOATE proprietățile potrivite, selectate de AI.
     """
-    all_locations_dict = load_all_json_data()
+    all_locations_dict = await load_all_json_data()
     if not all_locations_dict:
         raise HTTPException(status_code=404, detail="Nicio analiză JSON nu a fost găsită.")
 
-    context_for_ai = json.dumps(list(all_locations_dict.values()), indent=2, ensure_ascii=False)
+    # Când bugetul poate fi citit direct din cerere, comparația se face în cod, fără AI
+    buget_eur = extract_budget_eur(request.cerinta_user)
+    if buget_eur is not None:
+        return {"rezultate": filter_by_budget(all_locations_dict, buget_eur)}
+
+    context_for_ai = _CACHE["context"]
     
     selected_locations_string = await select_matching_locations_with_ai(
         cerinta_user=request.cerinta_user,
@@ -160,13 +341,25 @@ async def get_json_recommendations_endpoint(request: UserRequest):
     if not selected_locations_string or selected_locations_string == "N/A":
         return {"rezultate": []} # Returneaza o lista goala pentru consistenta
 
-    location_names_list = [name.strip() for name in selected_locations_string.split(',')]
-    
-    matching_jsons = []
-    for name in location_names_list:
-        if name in all_locations_dict:
-            matching_jsons.append(all_locations_dict[name])
-            
-    sorted_results = sorted(matching_jsons, key=lambda x: x.get("cost_estimat_total_eur", 0))
-
-    return {"rezultate": sorted_results}
\ No newline at end of file
+    chosen = {name.strip() for name in selected_locations_string.split(',')}
+
+    # Numele sunt deja ordonate după cost, deci rezultatul iese sortat dintr-o singură trecere
+    sorted_results = [all_locations_dict[name] for name in _CACHE["sorted_names"] if name in chosen]
+
+    return {"rezultate": sorted_results}
+
+# --- 5. PORNIREA SERVERULUI ---
+# Echivalent cu: uvicorn script2_consultant_aiV2:app --loop uvloop --http httptools --workers 1 --limit-concurrency 200
+# Cu WORKERS > 1, limitele RPM/TPM se împart între workeri, dar cache-urile din memorie nu sunt comune.
+if __name__ == "__main__":
+    print("--- Serverul pornește ---")
+    print("Accesează documentația API la adresa: http://127.0.0.1:8000/docs")
+    uvicorn.run(
+        "script2_consultant_aiV2:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",  # uvloop nu există pe Windows
+        http="httptools",
+        workers=WORKERS,
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "200")),
+    )
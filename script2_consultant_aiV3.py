@@ -1,23 +1,48 @@
 import asyncio
-import json
+import atexit
+import logging
+import math
+import orjson
 import os
+import sys
+from hashlib import blake2b
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 from typing import Dict, List, Any
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from supabase import create_client, Client
+from supabase import acreate_client, AsyncClient
+from cachetools import TTLCache
 # Importă bibliotecile Google GenAI și Uvicorn
 import google.generativeai as genai
 from google.generativeai import types
 import uvicorn
+from aiolimiter import AsyncLimiter
 
 # --- 1. CONFIGURARE SDK ---
 load_dotenv()
 
+# Logging prin coadă: cererile doar pun mesajul în coadă, iar scrierea pe stdout se face
+# într-un thread separat (QueueListener). LOG_LEVEL=WARNING oprește și formatarea mesajelor INFO.
+# Handler-ul și nivelul sunt doar pe logger-ul acestui modul, ca log-urile httpx/httpcore ale
+# clientului Supabase să nu ajungă pe calea cererilor.
+_log_queue = Queue(-1)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger(__name__)
+logger.addHandler(QueueHandler(_log_queue))
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(supabase_url, supabase_key)
+# Clientul asincron este creat la pornirea aplicației (vezi connect_supabase), ca interogările
+# să nu blocheze event loop-ul
+supabase: AsyncClient = None
 
 try:
     # Preia cheia API din fișierul .env sau variabilele de mediu
@@ -30,27 +55,74 @@ try:
 except Exception as e:
     raise RuntimeError(f"EROARE: Nu s-a putut inițializa clientul GenAI. Detalii: {e}")
 
+# Modelul (vezi MODEL) și configurația de generare sunt create o singură dată și refolosite la fiecare cerere
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-pro")
+GEN_CFG = genai.types.GenerationConfig(response_mime_type="application/json", temperature=0.2)
+
 
 app = FastAPI(
+    default_response_class=ORJSONResponse,
     title="Consultant AI pentru Planuri de Renovare",
     description="Trimite un buget și primește planuri strategice de renovare (blueprints) pentru proprietățile potrivite."
 )
 
+# Originile front-end-ului permise de CORS, separate prin virgulă (ex: "https://app.exemplu.ro").
+# Variabilă obligatorie în .env: fără ea, browserele blochează toate cererile cross-origin.
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
-    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    allow_headers=["*"],
+    allow_methods=["POST"],
+    allow_headers=["content-type"],
+    max_age=86400,  # Browserele păstrează răspunsul la preflight 24h și nu mai trimit OPTIONS la fiecare cerere
 )
 
+@app.on_event("startup")
+async def verifica_cors():
+    """Avertizează la pornire dacă CORS_ORIGINS lipsește, altfel front-end-ul primește doar erori CORS."""
+    if not ALLOWED_ORIGINS:
+        logger.warning("⚠️ AVERTISMENT: 'CORS_ORIGINS' nu este setată în .env. Browserele vor bloca toate cererile către API.")
+
+@app.on_event("startup")
+async def connect_supabase():
+    """Creează clientul Supabase asincron o singură dată, la pornirea serverului."""
+    global supabase
+    supabase = await acreate_client(supabase_url, supabase_key)
+
+# Numărul maxim de cereri Gemini active simultan (restul așteaptă la semafor)
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# --- LIMITARE PROACTIVĂ A RATEI (RPM / TPM) ---
+# Limitatoarele sunt globale, deci toate cererile din proces împart aceeași cotă.
+# Fiecare worker uvicorn are propriile limitatoare, deci cota totală este împărțită la WORKERS
+# (aceeași valoare ca în __main__; la pornirea din CLI cu --workers N, setează și WORKERS=N).
+WORKERS = int(os.getenv("WORKERS", "1"))
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "60"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+
+rpm_limiter = AsyncLimiter(max(GEMINI_RPM // WORKERS, 1), 60)
+tpm_limiter = AsyncLimiter(max(GEMINI_TPM // 1000 // WORKERS, 1), 60)  # un permis = 1000 de tokeni
+
+def estimate_tokens(prompt: str) -> int:
+    """Estimare grosieră a tokenilor de intrare: ~4 caractere per token."""
+    return len(prompt) // 4
+
+async def throttle(prompt: str):
+    """Așteaptă până când cererea încape atât în limita RPM, cât și în cea TPM."""
+    permits = math.ceil(estimate_tokens(prompt) / 1000)
+    await tpm_limiter.acquire(min(max(permits, 1), tpm_limiter.max_rate))
+    await rpm_limiter.acquire()
+
 class UserRequest(BaseModel):
     cerinta_user: str
 
-def load_all_json_data() -> Dict[str, dict]:
-    """Încarcă toate fișierele JSON dintr-un folder specificat."""
+async def load_all_json_data() -> Dict[str, dict]:
+    """Încarcă toate analizele JSON active din Supabase."""
     all_data = {}
-    response = supabase.table('locatii').select('json_locatie').eq('de_folosit', True).execute()
+    response = await supabase.table('locatii').select('json_locatie').eq('de_folosit', True).execute()
     if response.data:
         for item in response.data:
             json_content = item.get('json_locatie', {})
@@ -59,62 +131,55 @@ def load_all_json_data() -> Dict[str, dict]:
                 all_data[location_name] = json_content
         
     return all_data
+
+# Locațiile se schimbă rar, deci sunt păstrate în memorie LOC_CACHE_TTL secunde
+_LOC_CACHE = TTLCache(maxsize=1, ttl=int(os.getenv("LOC_CACHE_TTL", "300")))
+_LOC_LOCK = asyncio.Lock()
+
+async def load_all_json_data_cached() -> Dict[str, dict]:
+    """Returnează locațiile din cache sau le reîncarcă din Supabase după expirare."""
+    async with _LOC_LOCK:
+        if "locatii" not in _LOC_CACHE:
+            all_data = await load_all_json_data()
+            if not all_data:
+                return all_data
+            _LOC_CACHE["locatii"] = all_data
+        return _LOC_CACHE["locatii"]
     
 # --- 2. FUNCȚIA DE FILTRARE A FOST ELIMINATĂ ---
 # async def select_matching_locations_with_ai(...): -> NU MAI EXISTĂ
 
-# --- 3. FUNCȚIA AI PENTRU GENERAREA PLANULUI STRATEGIC (Analizorul Detaliat) ---
-async def generate_renovation_blueprint_with_ai(property_data: Dict[str, Any], user_request: str) -> Dict[str, Any]:
-    """
-    Pentru o singură proprietate, generează un plan strategic de renovare (blueprint) extins,
-    incluzând analiză financiară, de risc și de planificare.
-    """
-    property_context = json.dumps(property_data, indent=2, ensure_ascii=False)
-    
-    prompt = f"""
-ACȚIONEAZĂ CA UN CONSULTANT SENIOR ÎN INVESTIȚII IMOBILIARE.
-
-CONTEXT:
-- Cerința utilizatorului: "{user_request}" (Extrage de aici bugetul maxim disponibil).
-- Datele complete ale proprietății de analizat: {property_context}
-
-MISIUNEA TA:
-Evaluează fezabilitatea renovării conform bugetului. Generează o analiză complexă în format JSON valid care include verdictul, planul de acțiune și analize suplimentare (financiare, de risc, planificare).
-
-STRUCTURA JSON DE IEȘIRE OBLIGATORIE:
-Respectă *strict* următoarea structură arborescentă JSON:
-
-```json
-{{
-  "analiza_investitie": {{
+# Structura JSON cerută pentru fiecare plan de renovare
+BLUEPRINT_SCHEMA = """{
+  "analiza_investitie": {
     "nume_locatie": "string",
     "buget_client_eur": "number",
     "cost_estimat_renovare_eur": "number",
-    "verdict": {{
+    "verdict": {
       "status": "string",
       "rezumat": "string",
       "recomandare_principala": "string"
-    }},
-    "plan_de_actiune": {{
+    },
+    "plan_de_actiune": {
       "tip_plan": "string",
       "elemente_de_executat": [
-        {{
+        {
           "element": "string",
           "stare": "string",
           "cost_estimat_element_eur": "number",
           "prioritate": "string (Critic/Major/Mediu)"
-        }}
+        }
       ],
       "elemente_amanate": [
-        {{
+        {
           "element": "string",
           "stare": "string",
           "cost_estimat_element_eur": "number",
           "prioritate": "string (Critic/Major/Mediu)"
-        }}
+        }
       ]
-    }},
-    "analiza_financiara": {{
+    },
+    "analiza_financiara": {
       "cost_estimat_total_eur": "number",
       "buget_disponibil_eur": "number",
       "fond_de_rezerva_recomandat_procent": "number",
@@ -122,41 +187,97 @@ Respectă *strict* următoarea structură arborescentă JSON:
       "cost_total_proiectat_eur": "number",
       "surplus_bugetar_estimat_eur": "number",
       "observatii_financiare": "string"
-    }},
-    "analiza_de_risc": {{
+    },
+    "analiza_de_risc": {
       "nivel_risc_general": "string (Scăzut/Mediu/Ridicat)",
       "riscuri_identificate": [
-        {{
+        {
           "risc": "string",
           "descriere": "string",
           "mitigare": "string"
-        }}
+        }
       ]
-    }},
-    "planificare_si_etape": {{
+    },
+    "planificare_si_etape": {
       "durata_estimata_saptamani": "string",
       "etape_recomandate": [
-        {{
+        {
           "etapa": "number",
           "nume": "string",
           "descriere": "string"
-        }}
+        }
       ]
-    }}
-  }}
-}}
+    }
+  }
+}"""
+
+# --- PROMPT-URI ---
+# Instrucțiunile și structura JSON sunt identice la fiecare cerere, deci sunt trimise ca
+# system instruction (un prefix stabil); la fiecare cerere se construiește doar partea
+# variabilă, din cerința utilizatorului și datele proprietăților.
+SYSTEM_INSTRUCTION = """ACȚIONEAZĂ CA UN CONSULTANT SENIOR ÎN INVESTIȚII IMOBILIARE.
+
+MISIUNEA TA:
+Vei primi cerința utilizatorului (din care extragi bugetul maxim disponibil) și datele complete ale proprietății de analizat.
+Evaluează fezabilitatea renovării conform bugetului. Generează o analiză complexă în format JSON valid care include verdictul, planul de acțiune și analize suplimentare (financiare, de risc, planificare).
+
+STRUCTURA JSON DE IEȘIRE OBLIGATORIE:
+Respectă *strict* următoarea structură arborescentă JSON:
+
+```json
+""" + BLUEPRINT_SCHEMA + "\n```\n"
+
+PROMPT_PREFIX = 'CONTEXT:\n- Cerința utilizatorului: "'
+PROMPT_MID = '" (Extrage de aici bugetul maxim disponibil).\n- Datele complete ale proprietății de analizat: '
+
+BATCH_PROMPT_MID = '" (Extrage de aici bugetul maxim disponibil).\n- Lista cu datele complete ale proprietăților de analizat: '
+BATCH_PROMPT_SUFFIX_HEAD = "\n\nAplică misiunea pentru FIECARE proprietate din listă și returnează un array JSON cu exact "
+BATCH_PROMPT_SUFFIX_TAIL = " obiecte, câte unul pentru fiecare proprietate, în aceeași ordine ca în listă, fiecare respectând strict structura de mai sus."
+
+# Instrucțiunile fixe stau în system_instruction și formează un prefix stabil, eligibil pentru
+# cache-ul implicit al Gemini. Un CachedContent explicit nu se poate crea: prefixul este sub
+# minimul de tokeni cerut de model.
+MODEL = genai.GenerativeModel(GEMINI_MODEL, system_instruction=SYSTEM_INSTRUCTION)
+
+# Răspunsurile foarte mari sunt parsate într-un thread, ca să nu țină ocupat event loop-ul
+LARGE_RESPONSE_CHARS = 1 << 20
+
+async def parse_json_response(text: str) -> Any:
+    """Parsează răspunsul JSON cu orjson; textele de peste LARGE_RESPONSE_CHARS sunt parsate într-un thread."""
+    if len(text) > LARGE_RESPONSE_CHARS:
+        return await asyncio.to_thread(orjson.loads, text)
+    return orjson.loads(text)
+
+# --- CACHE PENTRU PLANURI ---
+# Aceeași proprietate + aceeași cerință + același model => același plan, deci răspunsurile
+# reușite sunt păstrate în memorie BLUEPRINT_CACHE_TTL secunde (implicit 6 ore).
+_BLUEPRINT_CACHE = TTLCache(maxsize=1024, ttl=int(os.getenv("BLUEPRINT_CACHE_TTL", "21600")))
+
+def blueprint_cache_key(property_data: Dict[str, Any], user_request: str) -> str:
+    """Cheia cache-ului: hash-ul datelor proprietății, al cerinței și al modelului."""
+    payload = orjson.dumps({"p": property_data, "u": user_request, "m": GEMINI_MODEL}, option=orjson.OPT_SORT_KEYS)
+    return blake2b(payload, digest_size=16).hexdigest()
+
+# --- 3. FUNCȚIA AI PENTRU GENERAREA PLANULUI STRATEGIC (Analizorul Detaliat) ---
+async def generate_renovation_blueprint_with_ai(property_data: Dict[str, Any], user_request: str) -> Dict[str, Any]:
     """
+    Pentru o singură proprietate, generează un plan strategic de renovare (blueprint) extins,
+    incluzând analiză financiară, de risc și de planificare.
+    """
+    cache_key = blueprint_cache_key(property_data, user_request)
+    if cache_key in _BLUEPRINT_CACHE:
+        return _BLUEPRINT_CACHE[cache_key]
+
+    property_context = orjson.dumps(property_data).decode()
+    
+    prompt = "".join((PROMPT_PREFIX, user_request, PROMPT_MID, property_context))
     try:
-        # **CORECTAT** Numele modelului la 'gemini-1.5-pro-latest'
-        model = genai.GenerativeModel('gemini-2.5-pro')
-        response = await model.generate_content_async(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                response_mime_type="application/json",
-                temperature=0.2
-            )
-        )
-        return json.loads(response.text)
+        async with gemini_semaphore:
+            await throttle(prompt)
+            response = await MODEL.generate_content_async(prompt, generation_config=GEN_CFG)
+        blueprint = await parse_json_response(response.text)
+        _BLUEPRINT_CACHE[cache_key] = blueprint
+        return blueprint
     except Exception as e:
         return {
             "nume_locatie": property_data.get("nume_locatie", "N/A"),
@@ -165,39 +286,84 @@ Respectă *strict* următoarea structură arborescentă JSON:
             "rezumat": f"A apărut o eroare în timpul generării planului: {str(e)}",
         }
 
+# --- ANALIZĂ ÎN GRUP ---
+# Proprietățile sunt trimise către Gemini câte BLUEPRINT_BATCH_SIZE într-o singură cerere,
+# ca să nu repetăm instrucțiunile și structura JSON pentru fiecare proprietate.
+BLUEPRINT_BATCH_SIZE = int(os.getenv("BLUEPRINT_BATCH_SIZE", "5"))
+
+async def generate_renovation_blueprints_batch(properties: List[Dict[str, Any]], user_request: str) -> List[Dict[str, Any]]:
+    """
+    Generează planurile pentru un grup de proprietăți printr-o singură cerere Gemini, care
+    returnează câte un plan per proprietate, în aceeași ordine. Dacă răspunsul nu poate fi
+    folosit, fiecare proprietate este analizată separat.
+    """
+    cache_keys = [blueprint_cache_key(property_data, user_request) for property_data in properties]
+    results = [_BLUEPRINT_CACHE.get(key) for key in cache_keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if len(missing) <= 1:
+        return await asyncio.gather(*(generate_renovation_blueprint_with_ai(p, user_request) for p in properties))
+
+    properties_context = orjson.dumps([properties[i] for i in missing]).decode()
+    prompt = "".join((
+        PROMPT_PREFIX, user_request, BATCH_PROMPT_MID, properties_context,
+        BATCH_PROMPT_SUFFIX_HEAD, str(len(missing)), BATCH_PROMPT_SUFFIX_TAIL,
+    ))
+    try:
+        async with gemini_semaphore:
+            await throttle(prompt)
+            response = await MODEL.generate_content_async(prompt, generation_config=GEN_CFG)
+        blueprints = await parse_json_response(response.text)
+        if not isinstance(blueprints, list) or len(blueprints) != len(missing) or not all(isinstance(b, dict) for b in blueprints):
+            raise ValueError(f"răspunsul nu conține {len(missing)} planuri")
+    except Exception as e:
+        logger.warning("⚠️ AVERTISMENT: Analiza în grup a eșuat (%s). Se analizează fiecare proprietate separat.", e)
+        return await asyncio.gather(*(generate_renovation_blueprint_with_ai(p, user_request) for p in properties))
+
+    for i, blueprint in zip(missing, blueprints):
+        # Numele locației este preluat din date, nu din răspunsul AI
+        analiza = blueprint.get("analiza_investitie")
+        if properties[i].get("nume_locatie") and isinstance(analiza, dict):
+            analiza["nume_locatie"] = properties[i]["nume_locatie"]
+        _BLUEPRINT_CACHE[cache_keys[i]] = blueprint
+        results[i] = blueprint
+    return results
+
 # --- 4. MODIFICAT: ENDPOINT-UL API CARE ORCHESTREAZĂ TOTUL FĂRĂ FILTRU ---
+def start_blueprint_tasks(all_locations_dict: Dict[str, dict], cerinta_user: str) -> List[asyncio.Task]:
+    """
+    Pornește câte un task de generare a planurilor pentru fiecare grup de BLUEPRINT_BATCH_SIZE
+    locații. Toate task-urile pornesc imediat; semaforul limitează cererile active către Gemini.
+    """
+    logger.info("--- 🚀 Se pregătesc cererile pentru TOATE cele %d locații ---", len(all_locations_dict))
+    properties = list(all_locations_dict.values())
+    return [
+        asyncio.create_task(generate_renovation_blueprints_batch(properties[i:i + BLUEPRINT_BATCH_SIZE], cerinta_user))
+        for i in range(0, len(properties), BLUEPRINT_BATCH_SIZE)
+    ]
+
+async def stream_blueprints(tasks: List[asyncio.Task]):
+    """Trimite fiecare plan ca o linie NDJSON imediat ce grupul lui de proprietăți este gata."""
+    for next_done in asyncio.as_completed(tasks):
+        for blueprint in await next_done:
+            yield orjson.dumps(blueprint) + b"\n"
+
 @app.post("/planuri-renovare-strategice", response_model=Dict[str, List[Dict]])
 async def get_strategic_renovation_plans(request: UserRequest):
     """
     Orchestrează întregul proces: încarcă datele, generează planuri detaliate pentru TOATE 
-    locațiile în paralel cu pauză și returnează rezultatele.
+    locațiile în paralel și returnează rezultatele.
     """
-    all_locations_dict = load_all_json_data()
+    all_locations_dict = await load_all_json_data_cached()
     if not all_locations_dict:
         raise HTTPException(status_code=404, detail="Nicio analiză JSON nu a fost găsită în folderul 'Analiza_JSON'.")
 
-    # Pas 1: Preia numele tuturor locațiilor direct din datele încărcate
-    location_names_list = list(all_locations_dict.keys())
-    
-    # Pas 2: Crearea task-urilor pentru toate locațiile
-    tasks = []
-    delay_between_launches_seconds = 1
-    
-    print(f"--- 🚀 Se pregătesc cererile pentru TOATE cele {len(location_names_list)} locații ---")
-    for name in location_names_list:
-        if name in all_locations_dict:
-            property_data = all_locations_dict[name]
-            task = asyncio.create_task(
-                generate_renovation_blueprint_with_ai(property_data, request.cerinta_user)
-            )
-            tasks.append(task)
-            print(f"   -> Task pentru '{name}' a fost lansat.")
-            await asyncio.sleep(delay_between_launches_seconds)
+    # Pas 1 și 2: Crearea task-urilor pentru toate locațiile
+    tasks = start_blueprint_tasks(all_locations_dict, request.cerinta_user)
 
     # Pas 3: Așteptarea finalizării tuturor task-urilor
-    print("--- 🏁 Toate task-urile au fost lansate. Se așteaptă finalizarea... ---")
+    logger.info("--- 🏁 Toate task-urile au fost lansate. Se așteaptă finalizarea... ---")
     if tasks:
-        final_blueprints = await asyncio.gather(*tasks)
+        final_blueprints = [blueprint for group in await asyncio.gather(*tasks) for blueprint in group]
     else:
         final_blueprints = []
 
@@ -206,8 +372,31 @@ async def get_strategic_renovation_plans(request: UserRequest):
 
     return {"rezultate": sorted_results}
 
+@app.post("/planuri-renovare-strategice/stream")
+async def stream_strategic_renovation_plans(request: UserRequest):
+    """
+    Variantă streaming: fiecare plan este trimis ca o linie NDJSON imediat ce este gata, în
+    ordinea finalizării. Sortarea după scorul de investiție rămâne în sarcina clientului.
+    """
+    all_locations_dict = await load_all_json_data_cached()
+    if not all_locations_dict:
+        raise HTTPException(status_code=404, detail="Nicio analiză JSON nu a fost găsită în folderul 'Analiza_JSON'.")
+
+    tasks = start_blueprint_tasks(all_locations_dict, request.cerinta_user)
+    return StreamingResponse(stream_blueprints(tasks), media_type="application/x-ndjson")
+
 # --- 5. PORNIREA SERVERULUI ---
+# Echivalent cu: uvicorn script2_consultant_aiV3:app --loop uvloop --http httptools --workers 1 --limit-concurrency 200
+# Cu WORKERS > 1, limitele RPM/TPM se împart între workeri, dar cache-urile din memorie nu sunt comune.
 if __name__ == "__main__":
     print("--- Serverul pornește ---")
     print("Accesează documentația API la adresa: http://127.0.0.1:8000/docs")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "script2_consultant_aiV3:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",  # uvloop nu există pe Windows
+        http="httptools",
+        workers=WORKERS,
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "200")),
+    )
\ No newline at end of file
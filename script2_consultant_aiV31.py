@@ -1,29 +1,63 @@
 import asyncio
-import json
+import atexit
+import hmac
+import httpx
+import logging
+import numpy as np
+import math
+import orjson
 import os
 import re
+import sys
+from hashlib import blake2b
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 from typing import Dict, List, Any, Optional
 
 # FastAPI, Pydantic și Securitate
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, Header, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers
 
 
 # Servicii externe
-from supabase import create_client, Client
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+from cachetools import TTLCache
 import google.generativeai as genai
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServiceUnavailable
 import uvicorn
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_combine, wait_random_exponential
 from dotenv import load_dotenv
-import geopy.distance
 
 # --- 1. CONFIGURARE ---
 load_dotenv()
 
+# Logging prin coadă: cererile doar pun mesajul în coadă, iar scrierea pe stdout se face
+# într-un thread separat (QueueListener). LOG_LEVEL=WARNING oprește și formatarea mesajelor INFO.
+# Handler-ul și nivelul sunt doar pe logger-ul acestui modul, ca log-urile httpx/httpcore ale
+# clientului Supabase să nu ajungă pe calea cererilor.
+_log_queue = Queue(-1)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger(__name__)
+logger.addHandler(QueueHandler(_log_queue))
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+
 # Configurare Supabase
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(supabase_url, supabase_key)
+# Clientul asincron este creat la pornirea aplicației (vezi connect_supabase), ca interogările
+# să nu blocheze event loop-ul
+supabase: AsyncClient = None
+# Un singur client HTTP (pool de conexiuni keep-alive, HTTP/2) creat la pornire și refolosit de
+# clientul Supabase, ca rafalele de cereri să nu plătească de fiecare dată handshake-ul TCP/TLS
+HTTPX: httpx.AsyncClient = None
+HTTPX_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
 
 # Configurare Google GenAI
 try:
@@ -34,34 +68,115 @@ try:
 except Exception as e:
     raise RuntimeError(f"EROARE la inițializarea clientului GenAI: {e}")
 
-# Configurare Cheie Privată pentru API
+# Modelul (vezi MODEL) și configurația de generare sunt create o singură dată și refolosite la fiecare cerere
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-pro")
+GEN_CFG = genai.types.GenerationConfig(response_mime_type="application/json")
+
+# Configurare Cheie Privată pentru API (obligatorie în .env, la fel ca CORS_ORIGINS de mai jos)
 PRIVATE_KEY_CORECTA = os.getenv("PRIVATE_ACCESS_KEY")
 
+# Originile front-end-ului permise de CORS, separate prin virgulă (ex: "https://app.exemplu.ro").
+# Variabilă obligatorie în .env: fără ea, browserele blochează toate cererile cross-origin.
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
+
 # --- 2. SECURITATE ---
-async def verify_private_key(x_private_key: str | None = Header(None)):
-    """Verifică dacă header-ul X-Private-Key este prezent și corect."""
-    if not PRIVATE_KEY_CORECTA:
-        raise HTTPException(status_code=500, detail="Cheia privată a API-ului nu este configurată pe server.")
-    if not x_private_key:
-        raise HTTPException(status_code=401, detail="Header-ul X-Private-Key lipsește din request.")
-    if x_private_key != PRIVATE_KEY_CORECTA:
-        raise HTTPException(status_code=403, detail="Acces neautorizat. Cheia privată este invalidă.")
+# Rutele protejate de cheia privată (endpoint-ul principal și varianta streaming)
+PROTECTED_PATH_PREFIX = "/planuri-renovare-strategice"
+
+class PrivateKeyMiddleware:
+    """
+    Middleware ASGI care verifică header-ul X-Private-Key înainte ca cererea să ajungă la
+    FastAPI, astfel încât cererile neautorizate sunt respinse fără parsarea body-ului.
+    Comparația se face în timp constant (hmac.compare_digest).
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(PROTECTED_PATH_PREFIX):
+            await self.app(scope, receive, send)
+            return
+
+        x_private_key = Headers(scope=scope).get("x-private-key")
+        if not PRIVATE_KEY_CORECTA:
+            status_code, detail = 500, "Cheia privată a API-ului nu este configurată pe server."
+        elif not x_private_key:
+            status_code, detail = 401, "Header-ul X-Private-Key lipsește din request."
+        elif not hmac.compare_digest(x_private_key.encode(), PRIVATE_KEY_CORECTA.encode()):
+            status_code, detail = 403, "Acces neautorizat. Cheia privată este invalidă."
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        response = ORJSONResponse({"detail": detail}, status_code=status_code)
+        await response(scope, receive, send)
 
 # --- 3. APLICAȚIA FASTAPI ---
 app = FastAPI(
+    default_response_class=ORJSONResponse,
     title="Consultant AI Flexibil pentru Planuri de Renovare",
     description="API securizat care generează planuri strategice de renovare."
 )
 
+# Verificarea cheii private. Middleware-ul adăugat ultimul rulează primul, deci CORS (mai jos)
+# îl învelește: preflight-urile OPTIONS și răspunsurile 401/403 primesc header-ele CORS.
+app.add_middleware(PrivateKeyMiddleware)
+
 # Adăugarea middleware-ului CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Pentru producție, înlocuiește cu domeniul front-end-ului
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["POST"],
+    allow_headers=["content-type", "x-private-key", "if-none-match"],
+    expose_headers=["etag"],
+    max_age=86400,  # Browserele păstrează răspunsul la preflight 24h și nu mai trimit OPTIONS la fiecare cerere
 )
 
+@app.on_event("startup")
+async def verifica_cors():
+    """Avertizează la pornire dacă CORS_ORIGINS lipsește, altfel front-end-ul primește doar erori CORS."""
+    if not ALLOWED_ORIGINS:
+        logger.warning("⚠️ AVERTISMENT: 'CORS_ORIGINS' nu este setată în .env. Browserele vor bloca toate cererile către API.")
+
+@app.on_event("startup")
+async def connect_supabase():
+    """Creează clientul Supabase asincron o singură dată, la pornirea serverului."""
+    global supabase, HTTPX
+    HTTPX = httpx.AsyncClient(http2=True, limits=HTTPX_LIMITS, timeout=60)
+    supabase = await acreate_client(supabase_url, supabase_key, options=AsyncClientOptions(httpx_client=HTTPX))
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """Închide pool-ul de conexiuni HTTP la oprirea serverului."""
+    if HTTPX is not None:
+        await HTTPX.aclose()
+
+# Numărul maxim de cereri Gemini active simultan (restul așteaptă la semafor)
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+# --- LIMITARE PROACTIVĂ A RATEI (RPM / TPM) ---
+# Limitatoarele sunt globale, deci toate cererile din proces împart aceeași cotă.
+# Fiecare worker uvicorn are propriile limitatoare, deci cota totală este împărțită la WORKERS
+# (aceeași valoare ca în __main__; la pornirea din CLI cu --workers N, setează și WORKERS=N).
+WORKERS = int(os.getenv("WORKERS", "1"))
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "60"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+
+rpm_limiter = AsyncLimiter(max(GEMINI_RPM // WORKERS, 1), 60)
+tpm_limiter = AsyncLimiter(max(GEMINI_TPM // 1000 // WORKERS, 1), 60)  # un permis = 1000 de tokeni
+
+def estimate_tokens(prompt: str) -> int:
+    """Estimare grosieră a tokenilor de intrare: ~4 caractere per token."""
+    return len(prompt) // 4
+
+async def throttle(prompt: str):
+    """Așteaptă până când cererea încape atât în limita RPM, cât și în cea TPM."""
+    permits = math.ceil(estimate_tokens(prompt) / 1000)
+    await tpm_limiter.acquire(min(max(permits, 1), tpm_limiter.max_rate))
+    await rpm_limiter.acquire()
+
 # --- 4. STRUCTURI DE DATE (Pydantic Models) ---
 class UserRequest(BaseModel):
     cerinta_user: str
@@ -71,99 +186,179 @@ class UserRequest(BaseModel):
 
 # --- 5. FUNCȚII HELPER ---
 
-def este_in_raza(coord_start: tuple, coord_verificare: tuple, raza_km: float) -> tuple[bool, float]:
-    """Calculează distanța și returnează (True/False, distanța)."""
-    distanta_km = geopy.distance.great_circle(coord_start, coord_verificare).km
-    return distanta_km <= raza_km, distanta_km
+# Coordonatele din textul 'POINT(long lat)' returnat de get_locatii_ca_text
+COORD_RE = re.compile(r'-?\d+\.\d+')
+EARTH_DIAMETER_KM = 2 * 6371.009  # aceeași rază medie ca geopy.distance.great_circle
+
+def parse_point(geo_string: Optional[str]) -> Optional[tuple]:
+    """
+    Returnează (lat, long) din textul WKT 'POINT(long lat)'. Formatul cunoscut este despărțit
+    direct cu split; pentru orice alt format se folosește expresia regulată COORD_RE.
+    """
+    if not geo_string:
+        return None
+    try:
+        if geo_string.startswith('POINT(') and geo_string.endswith(')'):
+            long_str, lat_str = geo_string[6:-1].split(' ')
+        else:
+            long_str, lat_str = COORD_RE.findall(geo_string)
+        return float(lat_str), float(long_str)
+    except ValueError:
+        return None
 
-def incarca_toate_locatiile() -> List[Dict]:
+def semi_latimi_cutie(lat0: float, raza_km: float) -> tuple:
+    """
+    Semi-lățimile (în grade) ale dreptunghiului lat/long care încadrează exact cercul de rază
+    raza_km: asin(sin(r/R) / cos(lat0)) pe longitudine. Dacă cercul atinge un pol sau raza este
+    foarte mare, pe longitudine se acceptă orice valoare (180°).
+    """
+    unghi = raza_km / (EARTH_DIAMETER_KM / 2)
+    dlat = np.degrees(unghi)
+    sin_unghi, cos_lat = np.sin(unghi), np.cos(np.radians(lat0))
+    if unghi >= np.pi / 2 or sin_unghi >= cos_lat:
+        return dlat * 1.0001, 180.0
+    # O marjă minimă acoperă erorile de rotunjire de la marginea cercului
+    return dlat * 1.0001, np.degrees(np.arcsin(sin_unghi / cos_lat)) * 1.0001
+
+def haversine_np(lat0: float, lon0: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Distanțele pe cercul mare (km) de la un punct la un vector de puncte, calculate vectorizat."""
+    lat0, lon0, lats, lons = np.radians(lat0), np.radians(lon0), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lats) * np.sin((lons - lon0) / 2) ** 2
+    return EARTH_DIAMETER_KM * np.arcsin(np.sqrt(a))
+
+async def incarca_toate_locatiile() -> List[Dict]:
     """Încarcă numele și analiza JSON pentru toate locațiile active."""
     try:
-        response = supabase.table('locatii').select('nume_locatie, json_locatie').eq('de_folosit', True).execute()
+        response = await supabase.table('locatii').select('nume_locatie, json_locatie').eq('de_folosit', True).execute()
         return response.data
     except Exception as e:
-        print(f"❌ EROARE la încărcarea tuturor locațiilor: {e}")
+        logger.error("❌ EROARE la încărcarea tuturor locațiilor: %s", e)
         return []
 
-def gaseste_locatii_apropiate(coord_start: tuple, raza_km: float) -> List[Dict]:
-    """Filtrează locațiile și returnează o listă de dicționare (nume + json_locatie)."""
-    print(f"\n--- Se filtrează locațiile pe o rază de {raza_km} km de la {coord_start} ---")
+# Locațiile se schimbă rar, deci sunt păstrate în memorie LOC_CACHE_TTL secunde
+_LOC_CACHE = TTLCache(maxsize=1, ttl=int(os.getenv("LOC_CACHE_TTL", "300")))
+_LOC_LOCK = asyncio.Lock()
+# Incrementat la fiecare invalidare: o reîncărcare începută înainte de o modificare nu mai
+# este salvată în cache, ca lista veche să nu supraviețuiască până la expirarea TTL-ului
+_LOC_VERSIUNE = {"v": 0}
+
+async def incarca_toate_locatiile_cached() -> List[Dict]:
+    """Returnează locațiile active din cache sau le reîncarcă din Supabase după expirare."""
+    async with _LOC_LOCK:
+        if "locatii" not in _LOC_CACHE:
+            versiune = _LOC_VERSIUNE["v"]
+            locatii = await incarca_toate_locatiile()
+            if not locatii or versiune != _LOC_VERSIUNE["v"]:
+                return locatii
+            _LOC_CACHE["locatii"] = locatii
+        return _LOC_CACHE["locatii"]
+
+def invalideaza_cache_locatii(_payload=None):
+    """Golește cache-ul de locații; următoarea cerere le reîncarcă din Supabase."""
+    _LOC_VERSIUNE["v"] += 1
+    _LOC_CACHE.clear()
+
+@app.on_event("startup")
+async def subscribe_locatii_changes():
+    """
+    Ascultă modificările tabelului 'locatii' prin Supabase Realtime și invalidează cache-ul la
+    INSERT/UPDATE/DELETE (tabelul trebuie adăugat în publicația supabase_realtime). Dacă
+    abonarea eșuează, cache-ul expiră oricum după LOC_CACHE_TTL secunde.
+    """
+    try:
+        channel = supabase.channel("locatii-changes")
+        channel.on_postgres_changes("*", schema="public", table="locatii", callback=invalideaza_cache_locatii)
+        await channel.subscribe()
+    except Exception as e:
+        logger.warning("⚠️ AVERTISMENT: Abonarea Realtime la 'locatii' a eșuat (%s). Cache-ul expiră după TTL.", e)
+
+async def gaseste_locatii_apropiate(coord_start: tuple, raza_km: float) -> List[Dict]:
+    """
+    Returnează locațiile active din rază ca listă de dicționare (nume + json_locatie).
+    Filtrarea se face în Postgres (ST_DWithin, vezi sql/02_get_locatii_in_radius.sql);
+    dacă funcția RPC nu există încă în baza de date, se filtrează local.
+    """
+    logger.info("--- Se filtrează locațiile pe o rază de %s km de la %s ---", raza_km, coord_start)
+    lat, long = coord_start
+    try:
+        response = await supabase.rpc('get_locatii_in_radius', {'lat': lat, 'lng': long, 'radius_m': raza_km * 1000}).execute()
+        return response.data or []
+    except Exception as e:
+        logger.warning("⚠️ AVERTISMENT: Filtrarea în baza de date a eșuat (%s). Se filtrează local.", e)
+        return await gaseste_locatii_apropiate_local(coord_start, raza_km)
+
+async def gaseste_locatii_apropiate_local(coord_start: tuple, raza_km: float) -> List[Dict]:
+    """Filtrează locațiile în Python și returnează o listă de dicționare (nume + json_locatie)."""
     try:
-        response = supabase.rpc('get_locatii_ca_text').execute()
+        response = await supabase.rpc('get_locatii_ca_text').execute()
         toate_locatiile_geo = response.data
         
-        locatii_filtrate_final = []
-        for locatie_geo in toate_locatiile_geo:
-            geo_string = locatie_geo.get('locatie_geo')
-            if not geo_string: continue
-
-            coords = re.findall(r'-?\d+\.\d+', geo_string)
-            if len(coords) == 2:
-                long_str, lat_str = coords
-                locatie_de_verificat = (float(lat_str), float(long_str))
-                
-                in_raza, distanta = este_in_raza(coord_start, locatie_de_verificat, raza_km)
-                if in_raza:
-                    nume_locatie = locatie_geo.get('nume_locatie')
-                    print(f"✅ Găsit în rază: '{nume_locatie}' (la {distanta:.2f} km)")
-                    
-                    full_data_resp = supabase.table('locatii').select('nume_locatie, json_locatie').eq('nume_locatie', nume_locatie).single().execute()
-                    if full_data_resp.data:
-                        locatii_filtrate_final.append(full_data_resp.data)
-        
-        return locatii_filtrate_final
-    except Exception as e:
-        print(f"❌ EROARE la filtrarea locațiilor: {e}")
-        return []
+        # Coordonatele sunt extrase o singură dată, apoi distanțele se calculează pentru toate locațiile deodată
+        puncte = [
+            (locatie_geo.get('nume_locatie'), *coords)
+            for locatie_geo in toate_locatiile_geo
+            if (coords := parse_point(locatie_geo.get('locatie_geo')))
+        ]
+        if not puncte:
+            return []
 
-async def generate_renovation_blueprint_with_ai(property_data: Dict[str, Any], user_request: str) -> Dict[str, Any]:
-    """Generează un plan de renovare detaliat folosind AI."""
-    property_context = json.dumps(property_data, indent=2, ensure_ascii=False)
-    
-    prompt = f"""
-ACȚIONEAZĂ CA UN CONSULTANT SENIOR ÎN INVESTIȚII IMOBILIARE.
+        nume, lats, lons = zip(*puncte)
+        lats, lons = np.array(lats), np.array(lons)
 
-CONTEXT:
-- Cerința utilizatorului: "{user_request}" (Extrage de aici bugetul maxim disponibil).
-- Datele complete ale proprietății de analizat: {property_context}
+        # Dreptunghiul care încadrează cercul elimină majoritatea locațiilor doar prin comparații,
+        # astfel încât haversine se calculează numai pentru cele rămase
+        lat0, lon0 = coord_start
+        dlat, dlon = semi_latimi_cutie(lat0, raza_km)
+        # Diferența de longitudine este adusă în [-180, 180), ca cercurile de lângă antimeridian să fie corecte
+        candidati = np.nonzero((np.abs(lats - lat0) <= dlat) & (np.abs((lons - lon0 + 180) % 360 - 180) <= dlon))[0]
 
-MISIUNEA TA:
-Evaluează fezabilitatea renovării conform bugetului. Generează o analiză complexă în format JSON valid care include verdictul, planul de acțiune și analize suplimentare (financiare, de risc, planificare).
+        distante = haversine_np(lat0, lon0, lats[candidati], lons[candidati])
+        nume_in_raza = []
+        for i, distanta in zip(candidati[distante <= raza_km], distante[distante <= raza_km]):
+            logger.debug("✅ Găsit în rază: '%s' (la %.2f km)", nume[i], distanta)
+            nume_in_raza.append(nume[i])
 
-STRUCTURA JSON DE IEȘIRE OBLIGATORIE:
-Respectă *strict* următoarea structură arborescentă JSON:
+        if not nume_in_raza:
+            return []
 
-```json
-{{
-  "analiza_investitie": {{
+        # Analizele complete sunt aduse printr-o singură interogare, nu câte una per locație
+        full_data_resp = await supabase.table('locatii').select('nume_locatie, json_locatie').in_('nume_locatie', nume_in_raza).execute()
+        return full_data_resp.data or []
+    except Exception as e:
+        logger.error("❌ EROARE la filtrarea locațiilor: %s", e)
+        return []
+
+# Structura JSON cerută pentru fiecare plan de renovare
+BLUEPRINT_SCHEMA = """{
+  "analiza_investitie": {
     "nume_locatie": "string",
     "buget_client_eur": "number",
     "cost_estimat_renovare_eur": "number",
-    "verdict": {{
+    "verdict": {
       "status": "string",
       "rezumat": "string",
       "recomandare_principala": "string"
-    }},
-    "plan_de_actiune": {{
+    },
+    "plan_de_actiune": {
       "tip_plan": "string",
       "elemente_de_executat": [
-        {{
+        {
           "element": "string",
           "stare": "string",
           "cost_estimat_element_eur": "number",
           "prioritate": "string (Critic/Major/Mediu)"
-        }}
+        }
       ],
       "elemente_amanate": [
-        {{
+        {
           "element": "string",
           "stare": "string",
           "cost_estimat_element_eur": "number",
           "prioritate": "string (Critic/Major/Mediu)"
-        }}
+        }
       ]
-    }},
-    "analiza_financiara": {{
+    },
+    "analiza_financiara": {
       "cost_estimat_total_eur": "number",
       "buget_disponibil_eur": "number",
       "fond_de_rezerva_recomandat_procent": "number",
@@ -171,64 +366,250 @@ Respectă *strict* următoarea structură arborescentă JSON:
       "cost_total_proiectat_eur": "number",
       "surplus_bugetar_estimat_eur": "number",
       "observatii_financiare": "string"
-    }},
-    "analiza_de_risc": {{
+    },
+    "analiza_de_risc": {
       "nivel_risc_general": "string (Scăzut/Mediu/Ridicat)",
       "riscuri_identificate": [
-        {{
+        {
           "risc": "string",
           "descriere": "string",
           "mitigare": "string"
-        }}
+        }
       ]
-    }},
-    "planificare_si_etape": {{
+    },
+    "planificare_si_etape": {
       "durata_estimata_saptamani": "string",
       "etape_recomandate": [
-        {{
+        {
           "etapa": "number",
           "nume": "string",
           "descriere": "string"
-        }}
+        }
       ]
-    }}
-  }}
-}}
-    """ 
+    }
+  }
+}"""
+
+# --- PROMPT-URI ---
+# Instrucțiunile și structura JSON sunt identice la fiecare cerere, deci sunt trimise ca
+# system instruction (un prefix stabil); la fiecare cerere se construiește doar partea
+# variabilă, din cerința utilizatorului și datele proprietăților.
+SYSTEM_INSTRUCTION = """ACȚIONEAZĂ CA UN CONSULTANT SENIOR ÎN INVESTIȚII IMOBILIARE.
+
+MISIUNEA TA:
+Vei primi cerința utilizatorului (din care extragi bugetul maxim disponibil) și datele complete ale proprietății de analizat.
+Evaluează fezabilitatea renovării conform bugetului. Generează o analiză complexă în format JSON valid care include verdictul, planul de acțiune și analize suplimentare (financiare, de risc, planificare).
+
+STRUCTURA JSON DE IEȘIRE OBLIGATORIE:
+Respectă *strict* următoarea structură arborescentă JSON:
+
+```json
+""" + BLUEPRINT_SCHEMA + "\n```\n"
+
+PROMPT_PREFIX = 'CONTEXT:\n- Cerința utilizatorului: "'
+PROMPT_MID = '" (Extrage de aici bugetul maxim disponibil).\n- Datele complete ale proprietății de analizat: '
+
+BATCH_PROMPT_MID = '" (Extrage de aici bugetul maxim disponibil).\n- Lista cu datele complete ale proprietăților de analizat: '
+BATCH_PROMPT_SUFFIX_HEAD = "\n\nAplică misiunea pentru FIECARE proprietate din listă și returnează un array JSON cu exact "
+BATCH_PROMPT_SUFFIX_TAIL = " obiecte, câte unul pentru fiecare proprietate, în aceeași ordine ca în listă, fiecare respectând strict structura de mai sus."
+
+# Instrucțiunile fixe stau în system_instruction și formează un prefix stabil, eligibil pentru
+# cache-ul implicit al Gemini. Un CachedContent explicit nu se poate crea: prefixul este sub
+# minimul de tokeni cerut de model.
+MODEL = genai.GenerativeModel(GEMINI_MODEL, system_instruction=SYSTEM_INSTRUCTION)
+
+# Răspunsurile foarte mari sunt parsate într-un thread, ca să nu țină ocupat event loop-ul
+LARGE_RESPONSE_CHARS = 1 << 20
+
+async def parse_json_response(text: str) -> Any:
+    """Parsează răspunsul JSON cu orjson; textele de peste LARGE_RESPONSE_CHARS sunt parsate într-un thread."""
+    if len(text) > LARGE_RESPONSE_CHARS:
+        return await asyncio.to_thread(orjson.loads, text)
+    return orjson.loads(text)
+
+async def generate_text_streamed(model: genai.GenerativeModel, prompt: str) -> str:
+    """
+    Cere răspunsul în modul streaming și îl asamblează din fragmente pe măsură ce sosesc,
+    în loc să aștepte un singur răspuns complet.
+    """
+    response = await model.generate_content_async(prompt, generation_config=GEN_CFG, stream=True)
+    parts = []
+    async for chunk in response:
+        # Fragmentele fără conținut (ex: doar finish_reason sau safety) nu au .text
+        if chunk.parts:
+            parts.append(chunk.text)
+    return "".join(parts)
+
+# --- REÎNCERCĂRI LA ERORI TEMPORARE (429 / 503 / 504) ---
+def wait_retry_after(retry_state):
+    """Respectă întârzierea cerută de server (RetryInfo), dacă aceasta există."""
+    exc = retry_state.outcome.exception()
+    for detail in getattr(exc, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return 0
+
+@retry(
+    retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable, DeadlineExceeded)),
+    wait=wait_combine(wait_retry_after, wait_random_exponential(min=1, max=20)),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+async def generate_with_retry(prompt: str) -> str:
+    """
+    Trimite cererea către Gemini, reîncercând automat la erori temporare. Semaforul este
+    eliberat cât timp se așteaptă între încercări, ca alte cereri să poată rula.
+    """
+    async with gemini_semaphore:
+        await throttle(prompt)
+        return await generate_text_streamed(MODEL, prompt)
+
+# --- CACHE PENTRU PLANURI ---
+# Aceeași proprietate + aceeași cerință + același model => același plan, deci răspunsurile
+# reușite sunt păstrate în memorie BLUEPRINT_CACHE_TTL secunde (implicit 6 ore).
+_BLUEPRINT_CACHE = TTLCache(maxsize=1024, ttl=int(os.getenv("BLUEPRINT_CACHE_TTL", "21600")))
+
+def blueprint_cache_key(property_data: Dict[str, Any], user_request: str) -> str:
+    """Cheia cache-ului: hash-ul datelor proprietății, al cerinței și al modelului."""
+    payload = orjson.dumps({"p": property_data, "u": user_request, "m": GEMINI_MODEL}, option=orjson.OPT_SORT_KEYS)
+    return blake2b(payload, digest_size=16).hexdigest()
+
+# Statusul planurilor care nu au putut fi generate (răspunsul nu este memorat în cache)
+STATUS_EROARE_AI = "Eroare la Analiza AI"
+
+# Generările în curs, după cheia de cache: cererile simultane pentru aceeași proprietate
+# (și aceeași cerință) așteaptă același rezultat în loc să trimită încă un apel Gemini.
+_IN_FLIGHT: Dict[str, asyncio.Future] = {}
+
+def register_in_flight(cache_keys: List[str]) -> Dict[str, asyncio.Future]:
+    """Marchează cheile ca fiind în curs de generare și returnează future-urile lor."""
+    loop = asyncio.get_running_loop()
+    futures = {key: loop.create_future() for key in cache_keys}
+    _IN_FLIGHT.update(futures)
+    return futures
+
+def release_in_flight(futures: Dict[str, asyncio.Future]):
+    """Scoate cheile din _IN_FLIGHT; future-urile nerezolvate sunt anulate."""
+    for key, future in futures.items():
+        if _IN_FLIGHT.get(key) is future:
+            del _IN_FLIGHT[key]
+        if not future.done():
+            future.cancel()
+
+async def await_in_flight(cache_key: str) -> Optional[Dict[str, Any]]:
+    """Așteaptă generarea deja în curs pentru cheie; None dacă nu există sau a fost anulată."""
+    future = _IN_FLIGHT.get(cache_key)
+    if future is None:
+        return None
     try:
-        model = genai.GenerativeModel('gemini-2.5-pro')
-        response = await model.generate_content_async(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                response_mime_type="application/json"
-            )
-        )
-        return json.loads(response.text)
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        if future.cancelled():
+            return None
+        raise
+
+async def generate_renovation_blueprint_with_ai(property_data: Dict[str, Any], user_request: str) -> Dict[str, Any]:
+    """Generează un plan de renovare detaliat folosind AI."""
+    cache_key = blueprint_cache_key(property_data, user_request)
+    if cache_key in _BLUEPRINT_CACHE:
+        return _BLUEPRINT_CACHE[cache_key]
+    blueprint = await await_in_flight(cache_key)
+    if blueprint is not None:
+        return blueprint
+
+    property_context = orjson.dumps(property_data).decode()
+    
+    prompt = "".join((PROMPT_PREFIX, user_request, PROMPT_MID, property_context))
+    futures = register_in_flight([cache_key])
+    try:
+        text = await generate_with_retry(prompt)
+        blueprint = await parse_json_response(text)
+        _BLUEPRINT_CACHE[cache_key] = blueprint
     except Exception as e:
-        return {"analiza_investitie": {"verdict": {"status": "Eroare la Analiza AI", "rezumat": str(e)}}}
+        blueprint = {"analiza_investitie": {"verdict": {"status": STATUS_EROARE_AI, "rezumat": str(e)}}}
+    finally:
+        if blueprint is not None:
+            futures[cache_key].set_result(blueprint)
+        release_in_flight(futures)
+    return blueprint
+
+# --- ANALIZĂ ÎN GRUP ---
+# Proprietățile sunt trimise către Gemini câte BLUEPRINT_BATCH_SIZE într-o singură cerere,
+# ca să nu repetăm instrucțiunile și structura JSON pentru fiecare proprietate.
+BLUEPRINT_BATCH_SIZE = int(os.getenv("BLUEPRINT_BATCH_SIZE", "5"))
+
+async def generate_renovation_blueprints_batch(properties: List[Dict[str, Any]], user_request: str) -> List[Dict[str, Any]]:
+    """
+    Generează planurile pentru un grup de proprietăți printr-o singură cerere Gemini, care
+    returnează câte un plan per proprietate, în aceeași ordine. Dacă răspunsul nu poate fi
+    folosit, fiecare proprietate este analizată separat.
+    """
+    cache_keys = [blueprint_cache_key(property_data, user_request) for property_data in properties]
+    results = [_BLUEPRINT_CACHE.get(key) for key in cache_keys]
+    # Duplicatele din grup și proprietățile generate deja de alte cereri nu sunt trimise din nou
+    de_generat = {}
+    for i, key in enumerate(cache_keys):
+        if results[i] is None and key not in _IN_FLIGHT and key not in de_generat:
+            de_generat[key] = i
+    missing = list(de_generat.values())
+    if len(missing) <= 1:
+        return await asyncio.gather(*(generate_renovation_blueprint_with_ai(p, user_request) for p in properties))
+
+    properties_context = orjson.dumps([properties[i] for i in missing]).decode()
+    prompt = "".join((
+        PROMPT_PREFIX, user_request, BATCH_PROMPT_MID, properties_context,
+        BATCH_PROMPT_SUFFIX_HEAD, str(len(missing)), BATCH_PROMPT_SUFFIX_TAIL,
+    ))
+    futures = register_in_flight(list(de_generat))
+    try:
+        text = await generate_with_retry(prompt)
+        blueprints = await parse_json_response(text)
+        if not isinstance(blueprints, list) or len(blueprints) != len(missing) or not all(isinstance(b, dict) for b in blueprints):
+            raise ValueError(f"răspunsul nu conține {len(missing)} planuri")
+
+        for i, blueprint in zip(missing, blueprints):
+            # Numele locației este preluat din date, nu din răspunsul AI
+            analiza = blueprint.get("analiza_investitie")
+            if properties[i].get("nume_locatie") and isinstance(analiza, dict):
+                analiza["nume_locatie"] = properties[i]["nume_locatie"]
+            _BLUEPRINT_CACHE[cache_keys[i]] = blueprint
+            futures[cache_keys[i]].set_result(blueprint)
+            results[i] = blueprint
+    except Exception as e:
+        logger.warning("⚠️ AVERTISMENT: Analiza în grup a eșuat (%s). Se analizează fiecare proprietate separat.", e)
+        release_in_flight(futures)
+        return await asyncio.gather(*(generate_renovation_blueprint_with_ai(p, user_request) for p in properties))
+    finally:
+        release_in_flight(futures)
+
+    # Restul (duplicate sau generări în curs în alte cereri) vin din cache sau din _IN_FLIGHT
+    ramase = [i for i, result in enumerate(results) if result is None]
+    for i, blueprint in zip(ramase, await asyncio.gather(*(generate_renovation_blueprint_with_ai(properties[i], user_request) for i in ramase))):
+        results[i] = blueprint
+    return results
 
 # --- 6. ENDPOINT-UL API PRINCIPAL ---
-@app.post("/planuri-renovare-strategice", response_model=Dict[str, List[Dict]])
-async def get_strategic_renovation_plans(request: UserRequest, _=Depends(verify_private_key)):
+async def pregateste_proprietati(request: UserRequest) -> List[Dict[str, Any]]:
     """
-    Orchestrează procesul: filtrează (opțional) și analizează locațiile.
-    Acest endpoint este protejat de o cheie privată.
+    Selectează locațiile (cu filtru geografic, dacă a fost cerut) și returnează analizele lor
+    JSON, cu numele corect al locației injectat.
     """
     locatii_de_procesat = []
 
     if request.latitudine is not None and request.longitudine is not None and request.raza_km is not None:
-        print("MOD DE OPERARE: Filtrare Geografică")
+        logger.info("MOD DE OPERARE: Filtrare Geografică")
         coord_start = (request.latitudine, request.longitudine)
-        locatii_de_procesat = gaseste_locatii_apropiate(coord_start, request.raza_km)
+        locatii_de_procesat = await gaseste_locatii_apropiate(coord_start, request.raza_km)
     else:
-        print("MOD DE OPERARE: Analiză Totală (fără filtru geo)")
-        locatii_de_procesat = incarca_toate_locatiile()
+        logger.info("MOD DE OPERARE: Analiză Totală (fără filtru geo)")
+        locatii_de_procesat = await incarca_toate_locatiile_cached()
     
     if not locatii_de_procesat:
-        return {"rezultate": []}
+        return []
 
-    tasks = []
-    print(f"\n--- 🚀 Se pregătesc cererile AI pentru {len(locatii_de_procesat)} locații ---")
+    proprietati = []
+    logger.info("--- 🚀 Se pregătesc cererile AI pentru %d locații ---", len(locatii_de_procesat))
     
     for locatie_data in locatii_de_procesat:
         nume_corect = locatie_data.get('nume_locatie')
@@ -243,18 +624,102 @@ async def get_strategic_renovation_plans(request: UserRequest, _=Depends(verify_
         if 'analiza_investitie' in analiza_json and 'nume_locatie' in analiza_json['analiza_investitie']:
             analiza_json['analiza_investitie']['nume_locatie'] = nume_corect
             
-        print(f"  -> Se pregătește task pentru '{nume_corect}'")
-        tasks.append(generate_renovation_blueprint_with_ai(analiza_json, request.cerinta_user))
+        logger.debug("  -> Se pregătește analiza pentru '%s'", nume_corect)
+        proprietati.append(analiza_json)
+    return proprietati
+
+def pregateste_task_uri(proprietati: List[Dict[str, Any]], cerinta_user: str) -> List[asyncio.Task]:
+    """Pornește câte un task de generare a planurilor pentru fiecare grup de BLUEPRINT_BATCH_SIZE proprietăți."""
+    return [
+        asyncio.create_task(generate_renovation_blueprints_batch(proprietati[i:i + BLUEPRINT_BATCH_SIZE], cerinta_user))
+        for i in range(0, len(proprietati), BLUEPRINT_BATCH_SIZE)
+    ]
+
+def este_plan_valid(blueprint: Dict[str, Any]) -> bool:
+    """False pentru planurile-eroare returnate când analiza AI a eșuat."""
+    verdict = (blueprint.get("analiza_investitie") or {}).get("verdict") or {}
+    return verdict.get("status") != STATUS_EROARE_AI
+
+def calculeaza_etag(proprietati: List[Dict[str, Any]], cerinta_user: str) -> str:
+    """
+    ETag-ul răspunsului: hash-ul proprietăților selectate, al cerinței și al modelului. Se
+    calculează înainte de orice apel Gemini, ca o cerere repetată să primească 304 fără costuri.
+    """
+    payload = orjson.dumps({"p": proprietati, "u": cerinta_user, "m": GEMINI_MODEL}, option=orjson.OPT_SORT_KEYS)
+    return '"' + blake2b(payload, digest_size=16).hexdigest() + '"'
+
+def etag_potrivit(etag: str, if_none_match: Optional[str]) -> bool:
+    """Verifică dacă header-ul If-None-Match conține ETag-ul curent."""
+    if not if_none_match:
+        return False
+    return any(valoare.strip() in (etag, "*", "W/" + etag) for valoare in if_none_match.split(","))
 
-    print("--- 🏁 Se așteaptă finalizarea analizelor AI... ---")
-    final_blueprints = await asyncio.gather(*tasks)
-    return {"rezultate": final_blueprints}
+# Clientul poate păstra răspunsul, dar trebuie să-l revalideze (If-None-Match) la fiecare cerere
+CACHE_CONTROL = "private, no-cache"
+
+async def stream_blueprints(tasks: List[asyncio.Task]):
+    """
+    Trimite fiecare plan ca o linie NDJSON imediat ce grupul lui de proprietăți este gata.
+    Dacă clientul se deconectează, task-urile rămase sunt anulate ca să nu consume cota Gemini.
+    """
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            for blueprint in await next_done:
+                yield orjson.dumps(blueprint) + b"\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@app.post("/planuri-renovare-strategice", response_model=Dict[str, List[Dict]])
+async def get_strategic_renovation_plans(request: UserRequest, if_none_match: Optional[str] = Header(None)):
+    """
+    Orchestrează procesul: filtrează (opțional) și analizează locațiile.
+    Acest endpoint este protejat de o cheie privată.
+    """
+    proprietati = await pregateste_proprietati(request)
+    headers = {"ETag": calculeaza_etag(proprietati, request.cerinta_user), "Cache-Control": CACHE_CONTROL}
+    if etag_potrivit(headers["ETag"], if_none_match):
+        return Response(status_code=304, headers=headers)
+
+    tasks = pregateste_task_uri(proprietati, request.cerinta_user)
+    final_blueprints = []
+    if tasks:
+        logger.info("--- 🏁 Se așteaptă finalizarea analizelor AI... ---")
+        final_blueprints = [blueprint for grup in await asyncio.gather(*tasks) for blueprint in grup]
+
+    continut = orjson.dumps({"rezultate": final_blueprints})
+    # ETag-ul este emis doar pentru răspunsurile complet reușite: clientul nu primește niciodată
+    # un ETag pentru planuri-eroare, deci nu le poate revalida cu 304 după ce Gemini își revine
+    if not all(este_plan_valid(blueprint) for blueprint in final_blueprints):
+        return Response(content=continut, media_type="application/json")
+    return Response(content=continut, media_type="application/json", headers=headers)
+
+@app.post("/planuri-renovare-strategice/stream")
+async def stream_strategic_renovation_plans(request: UserRequest):
+    """
+    Variantă streaming: fiecare plan este trimis ca o linie NDJSON imediat ce este gata,
+    în ordinea finalizării. Acest endpoint este protejat de o cheie privată.
+    """
+    proprietati = await pregateste_proprietati(request)
+    tasks = pregateste_task_uri(proprietati, request.cerinta_user)
+    return StreamingResponse(stream_blueprints(tasks), media_type="application/x-ndjson")
 
 # --- 7. PORNIREA SERVERULUI ---
+# Echivalent cu: uvicorn script2_consultant_aiV31:app --loop uvloop --http httptools --workers 1 --limit-concurrency 200 --timeout-keep-alive 30
+# Cu WORKERS > 1, limitele RPM/TPM se împart între workeri, dar cache-urile din memorie nu sunt comune.
 if __name__ == "__main__":
     if not PRIVATE_KEY_CORECTA:
         print("⚠️ AVERTISMENT: Cheia 'PRIVATE_ACCESS_KEY' nu este setată în .env. API-ul nu va fi securizat corespunzător.")
     
     print("--- Serverul pornește ---")
     print("Accesează documentația API la adresa: http://127.0.0.1:8000/docs")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "script2_consultant_aiV31:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",  # uvloop nu există pe Windows
+        http="httptools",
+        workers=WORKERS,
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "200")),
+        timeout_keep_alive=int(os.getenv("TIMEOUT_KEEP_ALIVE", "30")),  # conexiunile keep-alive rămân deschise între cererile clientului
+    )
\ No newline at end of file
@@ -0,0 +1,6 @@
+-- Hash-ul imaginilor + modelului + versiunii de prompt pentru fiecare analiză.
+alter table locatii add column if not exists prompt_hash text;
+
+-- prompt_hash nu este unic (locații diferite pot avea aceleași poze), deci upsert-ul din
+-- script1_analyzer2/3 folosește on_conflict='nume_locatie', care are nevoie de acest index unic.
+create unique index if not exists locatii_nume_idx on locatii (nume_locatie);
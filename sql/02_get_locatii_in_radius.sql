@@ -0,0 +1,14 @@
+-- Filtrarea geografică pentru script2_consultant_aiV31: Postgres returnează direct
+-- locațiile active aflate în rază, folosind indexul GiST în loc de o buclă în Python.
+create extension if not exists postgis;
+
+create index if not exists locatii_locatie_geo_gist_idx on locatii using gist ((locatie_geo::geography));
+
+create or replace function get_locatii_in_radius(lat float8, lng float8, radius_m float8)
+returns table (nume_locatie text, json_locatie jsonb)
+language sql stable as $$
+  select l.nume_locatie, l.json_locatie
+  from locatii l
+  where l.de_folosit
+    and ST_DWithin(l.locatie_geo::geography, ST_SetSRID(ST_MakePoint(lng, lat), 4326)::geography, radius_m);
+$$;
@@ -0,0 +1,6 @@
+-- Indexuri pentru interogările din script2_consultant_aiV31:
+--   * select(...).eq('de_folosit', True)      -> index parțial, conține doar locațiile active
+--   * select(...).in_('nume_locatie', [...])  -> folosește indexul unic locatii_nume_idx din 01_locatii_prompt_hash.sql
+-- RPC-ul get_locatii_ca_text trebuie să returneze doar (nume_locatie, locatie_geo), singurele
+-- coloane folosite de filtrarea locală; json_locatie este adus ulterior doar pentru locațiile din rază.
+create index if not exists locatii_de_folosit_idx on locatii (de_folosit) where de_folosit;